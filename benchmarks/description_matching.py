@@ -0,0 +1,152 @@
+""" Micro-benchmark of matching withholding taxes to dividends and interests by description.
+
+    Compares the former approach (longest common substring of the tax description and every
+    candidate description, computed with SequenceMatcher) with DescriptionMatcher on synthetic
+    IB-style descriptions where the correct candidate is known. Reports the time spent and the
+    share of taxes matched to the correct candidate.
+
+    Usage: python benchmarks/description_matching.py [taxes] [seed]
+"""
+import os
+import random
+import sys
+import timeit
+from difflib import SequenceMatcher
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from ib_edavki import DescriptionMatcher
+
+symbols = ["AAPL", "KO", "MSFT", "JNJ", "PG", "BABA", "VZ", "T", "O", "XOM"]
+months = [
+    "JAN", "FEB", "MAR", "APR", "MAY", "JUN", "JUL", "AUG", "SEP", "OCT", "NOV", "DEC"
+]
+
+
+def randomIsin(rng):
+    characters = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    return (
+        "US"
+        + "".join(rng.choice(characters) for i in range(9))
+        + str(rng.randrange(10))
+    )
+
+
+""" Returns a list of (taxDescription, candidateDescriptions, correctIndex) cases that mimic the
+    ambiguous cases in flex reports: dividends and payments in lieu of the same security on the
+    same day, bonus dividends next to ordinary ones and monthly interest in several currencies.
+"""
+def generateCases(count, rng):
+    cases = []
+    for i in range(count):
+        if rng.random() < 0.75:
+            symbol = rng.choice(symbols)
+            isin = randomIsin(rng)
+            amount = round(rng.uniform(0.01, 3), 2)
+            candidates = []
+            kinds = ["CASH DIVIDEND", "PAYMENT IN LIEU OF DIVIDEND", "BONUS"]
+            for kind in rng.sample(kinds, rng.randint(2, 3)):
+                if kind == "BONUS":
+                    candidates.append(
+                        "%s(%s) CASH DIVIDEND USD %s PER SHARE (Bonus Dividend)"
+                        % (symbol, isin, round(amount * 2, 2))
+                    )
+                else:
+                    candidates.append(
+                        "%s(%s) %s USD %s PER SHARE (Ordinary Dividend)"
+                        % (symbol, isin, kind, amount)
+                    )
+            correct = rng.randrange(len(candidates))
+            taxDescription = (
+                candidates[correct].replace(" (Ordinary Dividend)", "") + " - US TAX"
+            )
+        else:
+            currency = rng.choice(["USD", "EUR", "CHF"])
+            year = rng.randint(2018, 2025)
+            candidates = [
+                "%s CREDIT INT FOR %s-%s" % (currency, month, year)
+                for month in rng.sample(months, rng.randint(2, 6))
+            ]
+            correct = rng.randrange(len(candidates))
+            taxDescription = "WITHHOLDING @ 20%% ON %s" % candidates[correct][4:]
+        cases.append((taxDescription, candidates, correct))
+    return cases
+
+
+def matchWithSequenceMatcher(taxDescription, candidates):
+    closest = 0
+    bestMatchLen = 0
+    for i, description in enumerate(candidates):
+        match = SequenceMatcher(None, taxDescription, description).find_longest_match(
+            0, len(taxDescription), 0, len(description)
+        )
+        if match.size > bestMatchLen:
+            bestMatchLen = match.size
+            closest = i
+    return closest
+
+
+def matchWithDescriptionMatcher(matcher, taxDescription, candidates):
+    return matcher.findClosest(
+        taxDescription, range(len(candidates)), lambda i: candidates[i]
+    )
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    rng = random.Random(seed)
+    cases = generateCases(count, rng)
+
+    results = {}
+    timings = {}
+    timings["SequenceMatcher"] = timeit.timeit(
+        lambda: results.__setitem__(
+            "SequenceMatcher",
+            [
+                matchWithSequenceMatcher(tax, candidates)
+                for tax, candidates, correct in cases
+            ],
+        ),
+        number=1,
+    )
+
+    """ A real run scores every (tax, candidate) pair once, so the matcher starts with empty
+        caches. The warm pass repeats the same taxes on the filled caches and is reported
+        separately, it only shows the cost of cache hits.
+    """
+    matcher = DescriptionMatcher()
+
+    def runDescriptionMatcher():
+        results["DescriptionMatcher"] = [
+            matchWithDescriptionMatcher(matcher, tax, candidates)
+            for tax, candidates, correct in cases
+        ]
+
+    timings["DescriptionMatcher"] = timeit.timeit(runDescriptionMatcher, number=1)
+    warmTiming = timeit.timeit(runDescriptionMatcher, number=1)
+
+    print("%d taxes" % count)
+    for name in ("SequenceMatcher", "DescriptionMatcher"):
+        correctCount = sum(
+            1
+            for (tax, candidates, correct), chosen in zip(cases, results[name])
+            if chosen == correct
+        )
+        print(
+            "%-20s %8.3f s  %6.2f %% correct"
+            % (name, timings[name], 100.0 * correctCount / len(cases))
+        )
+    print(
+        "Speedup %.1fx, warm cache pass of DescriptionMatcher %.3f s"
+        % (timings["SequenceMatcher"] / timings["DescriptionMatcher"], warmTiming)
+    )
+    agreement = sum(
+        1
+        for a, b in zip(results["SequenceMatcher"], results["DescriptionMatcher"])
+        if a == b
+    )
+    print("Same choice in %.2f %% of the cases" % (100.0 * agreement / len(cases)))
+
+
+if __name__ == "__main__":
+    main()
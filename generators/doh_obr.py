@@ -1,20 +1,14 @@
-import urllib.request
-import sys
+import bisect
 import xml.etree.ElementTree
 import os.path
-from difflib import SequenceMatcher
+from collections import defaultdict
 from xml.dom import minidom
 
-""" Fetch ib-affiliates.xml from GitHub if it doesn't exist and use the data for Doh-Obr.xml """
+""" Use ib-affiliates.xml (fetched from GitHub at startup) for Doh-Obr.xml """
 
 
 def getIbAffiliateInfo(ibEntities, accountId):
     ibAffiliateCode = getIbEntityCode(ibEntities, accountId)
-    if not os.path.isfile("ib-affiliates.xml"):
-        urllib.request.urlretrieve(
-            "https://github.com/jamsix/ib-edavki/raw/master/ib-affiliates.xml",
-            "ib-affiliates.xml",
-        )
     if os.path.isfile("ib-affiliates.xml"):
         ibAffiliateInfos = xml.etree.ElementTree.parse("ib-affiliates.xml").getroot()
         for affiliate in ibAffiliateInfos:
@@ -60,140 +54,106 @@ def getIbEntityCode(ibEntities, accountId):
 def generate(
     taxpayerConfig,
     ibEntities,
-    ibCashTransactionsList,
-    rates,
+    cashTransactions,
+    rateTable,
+    descriptionMatcher,
     reportYear,
     test,
     testYearDiff,
+    filename="Doh-Obr.xml",
 ):
     interests = []
-    for ibCashTransactions in ibCashTransactionsList:
-        if ibCashTransactions is None:
-            continue
-
-        for ibCashTransaction in ibCashTransactions:
-            """ Ignore levelOfDetail="SUMMARY" CashTransactions """
-            if ibCashTransaction.attrib["transactionID"] == "":
-                continue
-            if (
-                ibCashTransaction.tag == "CashTransaction"
-                and ibCashTransaction.get("dateTime").startswith(str(reportYear))
-                and ibCashTransaction.get("type")
-                in ["Broker Interest Received", "Broker Fees"]
-            ):
-                interest = {
-                    "accountId": ibCashTransaction.get("accountId"),
-                    "currency": ibCashTransaction.get("currency"),
-                    "amount": float(ibCashTransaction.get("amount")),
-                    "description": ibCashTransaction.get("description"),
-                    "dateTime": ibCashTransaction.get("dateTime"),
-                    "transactionID": int(ibCashTransaction.get("transactionID")),
-                    "tax": 0,
-                }
-                interests.append(interest)
-
-        for ibCashTransaction in ibCashTransactions:
-            """ Ignore levelOfDetail="SUMMARY" CashTransactions """
-            if ibCashTransaction.attrib["transactionID"] == "":
-                continue
-            if (
-                ibCashTransaction.tag == "CashTransaction"
-                and ibCashTransaction.attrib["dateTime"].startswith(str(reportYear))
-                and ibCashTransaction.attrib["type"] == "Withholding Tax"
-                and ibCashTransaction.attrib["conid"] == ""
-            ):
-                potentiallyMatchingInterests = []
-                for interest in interests:
-                    if (
-                        interest["tax"] == 0
-                        and interest["dateTime"][0:8]
-                        == ibCashTransaction.attrib["dateTime"][0:8]
-                        and interest["currency"] == ibCashTransaction.attrib["currency"]
-                        and int(interest["transactionID"])
-                        < int(ibCashTransaction.attrib["transactionID"])
-                        and interest["amount"]
-                        * float(ibCashTransaction.attrib["amount"])
-                        < 0
-                    ):
-                        potentiallyMatchingInterests.append(interest)
-
-                if len(potentiallyMatchingInterests) == 0:
-                    print(
-                        "WARNING: Cannot find a matching interest for %s - %s."
-                        % (
-                            ibCashTransaction.attrib["description"],
-                            ibCashTransaction.attrib["amount"],
-                        )
+    """ Interests by (date, currency, sign of amount), each bucket sorted by (transactionID, position in interests) """
+    interestsByDateCurrencySign = defaultdict(list)
+    for statementCashTransactions in cashTransactions:
+        for date, ibCashTransaction in statementCashTransactions["interests"]:
+            interest = {
+                "accountId": ibCashTransaction.get("accountId"),
+                "currency": ibCashTransaction.get("currency"),
+                "amount": float(ibCashTransaction.get("amount")),
+                "description": ibCashTransaction.get("description"),
+                "dateTime": ibCashTransaction.get("dateTime"),
+                "transactionID": int(ibCashTransaction.get("transactionID")),
+                "tax": 0,
+            }
+            if interest["amount"] != 0:
+                bisect.insort(
+                    interestsByDateCurrencySign[
+                        (date, interest["currency"], interest["amount"] > 0)
+                    ],
+                    (interest["transactionID"], len(interests), interest),
+                )
+            interests.append(interest)
+
+        for date, ibCashTransaction in statementCashTransactions["interestTaxes"]:
+            """ Untaxed interests of the opposite sign paid on the same day in the same currency
+                before the tax, in the order of interests """
+            taxAmount = float(ibCashTransaction["amount"])
+            bucket = []
+            if taxAmount != 0:
+                bucket = interestsByDateCurrencySign.get(
+                    (date, ibCashTransaction["currency"], taxAmount < 0), []
+                )
+            candidates = bucket[
+                : bisect.bisect_left(bucket, (int(ibCashTransaction["transactionID"]),))
+            ]
+            potentiallyMatchingInterests = [
+                interest
+                for _, _, interest in sorted(candidates, key=lambda c: c[1])
+                if interest["tax"] == 0
+            ]
+
+            if len(potentiallyMatchingInterests) == 0:
+                print(
+                    "WARNING: Cannot find a matching interest for %s - %s."
+                    % (
+                        ibCashTransaction["description"],
+                        ibCashTransaction["amount"],
                     )
-                    continue
-                elif len(potentiallyMatchingInterests) == 1:
-                    closestInterest = potentiallyMatchingInterests[0]
-                else:
-                    """There are multiple interests that potentially match the given
-                    tax. Unfortunately there is no reference that would point the
-                    tax entry to an interests entry so we employ a simple string
-                    matching trick and find the interests with a description that is
-                    the closest to the tax description.
-                    """
-                    closestInterest = potentiallyMatchingInterests[0]
-                    bestMatchLen = 0
-                    for interest in potentiallyMatchingInterests:
-                        taxDescription = ibCashTransaction.attrib["description"]
-                        interestDescription = interest["description"]
-                        match = SequenceMatcher(
-                            None, taxDescription, interestDescription
-                        ).find_longest_match(
-                            0, len(taxDescription), 0, len(interestDescription)
-                        )
-                        if match.size > bestMatchLen:
-                            bestMatchLen = match.size
-                            closestInterest = interest
+                )
+                continue
+            elif len(potentiallyMatchingInterests) == 1:
+                closestInterest = potentiallyMatchingInterests[0]
+            else:
+                """There are multiple interests that potentially match the given
+                tax. Unfortunately there is no reference that would point the
+                tax entry to an interests entry so we employ a simple string
+                matching trick and find the interests with a description that is
+                the closest to the tax description.
+                """
+                closestInterest = descriptionMatcher.findClosest(
+                    ibCashTransaction["description"],
+                    potentiallyMatchingInterests,
+                    lambda interest: interest["description"],
+                )
 
-                closestInterestTax = -float(ibCashTransaction.attrib["amount"])
-                closestInterest["tax"] += closestInterestTax
+            closestInterestTax = -float(ibCashTransaction["amount"])
+            closestInterest["tax"] += closestInterestTax
 
     """ Convert to EUR """
-    for interest in interests:
-        if interest["currency"] == "EUR":
-            interest["amountEUR"] = interest["amount"]
-            interest["taxEUR"] = interest["tax"]
-        else:
-            date = interest["dateTime"][0:8]
-            currency = interest["currency"]
-            if date in rates and currency in rates[date]:
-                rate = float(rates[date][currency])
-            else:
-                for i in range(0, 6):
-                    date = str(int(date) - 1)
-                    if date in rates and currency in rates[date]:
-                        rate = float(rates[date][currency])
-                        print(
-                            "There is no exchange rate for "
-                            + str(interest["dateTime"][0:8])
-                            + ", using "
-                            + str(date)
-                        )
-                        break
-                    if i == 6:
-                        sys.exit("Error: There is no exchange rate for " + str(date))
-            interest["amountEUR"] = interest["amount"] / rate
-            interest["taxEUR"] = interest["tax"] / rate
+    amountsEUR = rateTable.convertToEUR(
+        (interest["dateTime"][0:8], interest["currency"], interest["amount"])
+        for interest in interests
+    )
+    taxesEUR = rateTable.convertToEUR(
+        (interest["dateTime"][0:8], interest["currency"], interest["tax"])
+        for interest in interests
+    )
+    for interest, amountEUR, taxEUR in zip(interests, amountsEUR, taxesEUR):
+        interest["amountEUR"] = amountEUR
+        interest["taxEUR"] = taxEUR
 
-    """ Merge multiple interests on the same day from the same company into a single entry """
-    mergedInterests = []
+    """ Merge multiple interests on the same day from the same company into a single entry,
+        accumulated into the first interest of the day """
+    mergedInterests = {}
     for interest in interests:
-        merged = False
-        for mergedInterest in mergedInterests:
-            if interest["dateTime"][0:8] == mergedInterest["dateTime"][0:8]:
-                mergedInterest["amountEUR"] = (
-                    mergedInterest["amountEUR"] + interest["amountEUR"]
-                )
-                mergedInterest["taxEUR"] = mergedInterest["taxEUR"] + interest["taxEUR"]
-                merged = True
-                break
-        if merged == False:
-            mergedInterests.append(interest)
-    interests = mergedInterests
+        mergedInterest = mergedInterests.get(interest["dateTime"][0:8])
+        if mergedInterest is None:
+            mergedInterests[interest["dateTime"][0:8]] = interest
+        else:
+            mergedInterest["amountEUR"] = mergedInterest["amountEUR"] + interest["amountEUR"]
+            mergedInterest["taxEUR"] = mergedInterest["taxEUR"] + interest["taxEUR"]
+    interests = list(mergedInterests.values())
 
     """ Generate Doh-Obr.xml """
     envelope = xml.etree.ElementTree.Element(
@@ -282,6 +242,6 @@ def generate(
 
     xmlString = xml.etree.ElementTree.tostring(envelope)
     prettyXmlString = minidom.parseString(xmlString).toprettyxml(indent="\t")
-    with open("Doh-Obr.xml", "w", encoding="utf-8") as f:
+    with open(filename, "w", encoding="utf-8") as f:
         f.write(prettyXmlString)
-        print("Doh-Obr.xml created")
+        print(filename + " created")
@@ -0,0 +1,87 @@
+""" Compact record types used instead of per-record dicts. Attributes that are not present
+    in the IB report are None. Repeated strings (currencies, symbols, asset categories, ...)
+    are interned, so thousands of records share a single copy of each. The records are kept in
+    their own module, so pickled parse caches refer to generators.records whether ib_edavki runs
+    as a script or through the console entry point.
+"""
+class Record:
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
+
+    def copy(self):
+        record = self.__class__.__new__(self.__class__)
+        for name in self.__slots__:
+            setattr(record, name, getattr(self, name))
+        return record
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+
+class Trade(Record):
+    __slots__ = (
+        "conid",
+        "symbol",
+        "currency",
+        "assetCategory",
+        "tradePrice",
+        "quantity",
+        "multiplier",
+        "buySell",
+        "tradeDate",
+        "tradeTime",
+        "transactionID",
+        "ibOrderID",
+        "openCloseIndicator",
+        "isin",
+        "cusip",
+        "securityID",
+        "description",
+        "lots",
+        "openTransactionIds",
+        "tradePriceEUR",
+        "positionType",
+        "assetType",
+    )
+
+
+class Lot(Record):
+    __slots__ = (
+        "transactionID",
+        "conid",
+        "symbol",
+        "openDateTime",
+        "quantity",
+        "date",
+        "time",
+    )
+
+
+class Dividend(Record):
+    __slots__ = (
+        "currency",
+        "type",
+        "conid",
+        "amount",
+        "symbol",
+        "description",
+        "dateTime",
+        "transactionID",
+        "tax",
+        "taxEUR",
+        "amountEUR",
+        "isin",
+        "securityID",
+        "name",
+        "taxNumber",
+        "address",
+        "country",
+        "reliefStatement",
+    )
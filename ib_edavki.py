@@ -1,52 +1,99 @@
 #!/usr/bin/python
 
 import argparse
-import copy
+import array
+import bisect
+import concurrent.futures
 import datetime
 import glob
+import hashlib
+import itertools
+import json
 import os
+import pickle
 import re
+import sqlite3
 import sys
 import requests
 import xml.etree.ElementTree
-from collections import defaultdict
+from collections import defaultdict, deque
 from difflib import SequenceMatcher
 from xml.dom import minidom
 
 from generators import doh_obr
+from generators.records import Dividend, Lot, Trade
 
 bsRateXmlUrl = "https://www.bsi.si/_data/tecajnice/dtecbs-l.xml"
+bsRateDailyXmlUrl = "https://www.bsi.si/_data/tecajnice/dtecbs.xml"
+bsRateDbFilename = "bsrates.sqlite"
+companiesXmlUrl = "https://github.com/jamsix/ib-edavki/raw/master/companies.xml"
+reliefStatementsXmlUrl = "https://github.com/jamsix/ib-edavki/raw/master/relief-statements.xml"
+ibAffiliatesXmlUrl = "https://github.com/jamsix/ib-edavki/raw/master/ib-affiliates.xml"
+# (connect, read) timeout in seconds of every remote request
+fetchTimeout = (5, 30)
 normalAssets = ["STK", "FUND"]
 derivateAssets = ["CFD", "FXCFD", "OPT", "FUT", "FOP", "WAR"]
 ignoreAssets = ["CASH", "CMDTY"]
 userAgent = 'ib-edavki'
-
-
-stockSplits = defaultdict(list)
-cusipIsinChanges = defaultdict(list)
-
-
+# Parsed IB XML files and HTTP metadata of fetched reference files are kept here
+cacheDir = "ib-edavki-cache"
+# Bump when the structure returned by parseIbXml changes, so that old cache entries are not used
+ibXmlCacheVersion = 3
+# Bump when the format of open lot snapshots changes
+openLotSnapshotVersion = 2
+# Bump when CompanyRegistry or the merge of companies changes, so that an old snapshot is not used
+companiesCacheVersion = 2
+
+
+# Distinct (timestamp, multiplier) stock splits by conid, timestamp is the integer YYYYMMDDHHMMSS
+stockSplits = defaultdict(set)
+# Split timelines by conid, built from stockSplits on first use
+splitTimelines = {}
+# Single CUSIP/ISIN changes (old -> new) as recorded from corporate actions
+cusipIsinChanges = {}
+# Final CUSIP/ISIN of every changed one, built by resolveCusipIsinChanges
+latestCusipIsins = {}
+
+
+def internOrNone(value):
+    if value is None or value == "":
+        return None
+    return sys.intern(value)
+
+
+""" Returns the split timeline of a conid: split timestamps in ascending order and suffix products of
+    their multipliers, i.e. multipliers[i] is the product of all splits from the i-th on (and the
+    last one is 1)
+"""
+def getSplitTimeline(key):
+    if key not in splitTimelines:
+        splits = sorted(stockSplits[key])
+        timestamps = [timestamp for timestamp, multiplier in splits]
+        multipliers = [1] * (len(splits) + 1)
+        for i in range(len(splits) - 1, -1, -1):
+            multipliers[i] = multipliers[i + 1] * splits[i][1]
+        splitTimelines[key] = (timestamps, multipliers)
+    return splitTimelines[key]
+
+
+""" Returns the product of multipliers of all splits after the given date and time """
 def getSplitMultiplier(symbol, conid, date, time):
-    multiplier = 1
     #key = f"{symbol}:{conid}"
     # If symbol changes after stock split then split is not found (eg. MMAT -> split -> rename to MMAT.OLD). Therefore only conid is considered for multiplier.
     key = f"{conid}"
 
     if key not in stockSplits:
-        return multiplier
-
-    for splitData in stockSplits[key]:
-        if datetime.datetime.strptime(date + " " + time, "%Y%m%d %H%M%S") < splitData["dateTime"]:
-            multiplier *= splitData["multiplier"]
+        return 1
 
-    return multiplier
+    timestamps, multipliers = getSplitTimeline(key)
+    return multipliers[bisect.bisect_right(timestamps, int(date + time))]
 
 
 """ Stores stock splits with multiplier by date and time
 """
 def addStockSplits(corporateActions):
     for action in corporateActions:
-        description = action.attrib["description"]
+        description = action["description"]
         descriptionSearch = re.search(r"SPLIT (.+) FOR (.+) \(", description)
         if descriptionSearch is not None:
             # we have to extract split information from description since IB does not provide
@@ -55,39 +102,70 @@ def addStockSplits(corporateActions):
             multiplier = float(descriptionSearch.group(1)) / float(
                 descriptionSearch.group(2)
             )
-            symbol = action.attrib["symbol"]
-            conid = action.attrib["conid"]
+            symbol = action["symbol"]
+            conid = action["conid"]
             #key = f"{symbol}:{conid}"
             # If symbol changes after stock split then split is not found (eg. MMAT -> split -> rename to MMAT.OLD). Therefore only conid is considered for multiplier.
             key = f"{conid}"
             """ dateTime is now the primary parameter, but old reports only have tradeDate and sometimes tradeTime """
             try:
-                strDateTime = action.attrib["dateTime"].split(";")
+                strDateTime = action["dateTime"].split(";")
                 strDate = strDateTime[0]
                 strTime = strDateTime[1]
             except:
-                print("Stock split Corporate Action for conid='" + conid + "' (symbol '" + symbol + "') has issues with dateTime attributes (" + action.attrib["dateTime"] + "), which is a crucial stock split information!")
+                print("Stock split Corporate Action for conid='" + conid + "' (symbol '" + symbol + "') has issues with dateTime attributes (" + action["dateTime"] + "), which is a crucial stock split information!")
                 return
             try:
-                dateTime = datetime.datetime.strptime(strDate + " " + strTime, "%Y%m%d %H%M%S")
+                datetime.datetime.strptime(strDate + " " + strTime, "%Y%m%d %H%M%S")
             except:
                 print("Stock split Corporate Action for conid='" + conid + "' (symbol '" + symbol + "') has issues with date and time attribute (" + strDate, strTime + "), which is a crucial stock split information!")
                 return               
 
-            # check if the same split was added from a different report
-            for split in stockSplits[key]:
-                if split["dateTime"] == dateTime and split["multiplier"] == multiplier:
-                    continue
-
-            stockSplits[key].append({"dateTime": dateTime, "multiplier": multiplier})
+            # the same split may be added from a different report, the set keeps it only once
+            stockSplits[key].add((int(strDate + strTime), multiplier))
+            splitTimelines.pop(key, None)
 
 
 def getLatestCusipIsin(cusipIsin):
-    return cusipIsinChanges.get(cusipIsin, cusipIsin)
+    return latestCusipIsins.get(cusipIsin, cusipIsin)
+
+
+""" Resolves chains of CUSIP/ISIN changes (i.e. A -> B -> C) into latestCusipIsins, so the final
+    CUSIP/ISIN of any changed one is a single lookup. Every chain is followed only once, all the
+    identifiers on it are mapped to its end. Changes that form a cycle are reported and ignored.
+"""
+def resolveCusipIsinChanges():
+    latestCusipIsins.clear()
+    for cusipIsin in cusipIsinChanges:
+        path = []
+        onPath = set()
+        latest = cusipIsin
+        while (
+            latest in cusipIsinChanges
+            and latest not in latestCusipIsins
+            and latest not in onPath
+        ):
+            path.append(latest)
+            onPath.add(latest)
+            latest = cusipIsinChanges[latest]
+        if latest in onPath:
+            cycle = path[path.index(latest) :]
+            if len(cycle) > 1:
+                print(
+                    "CUSIP/ISIN changes "
+                    + " -> ".join(cycle + [latest])
+                    + " form a cycle and are ignored"
+                )
+            for c in cycle:
+                latestCusipIsins[c] = c
+            path = path[: path.index(latest)]
+        latest = latestCusipIsins.get(latest, latest)
+        for c in path:
+            latestCusipIsins[c] = latest
 
 def updateChangedCusipIsin(corporateActions):
     for action in corporateActions:
-        description = action.attrib["description"]
+        description = action["description"]
         descriptionSearch = re.search(r"\(([^)]+)\) CUSIP/ISIN CHANGE TO \(([^)]+)\)", description)
         if descriptionSearch is not None:
             # we have to extract Cusp and/or ISIN change information from description since IB does not provide
@@ -97,31 +175,1294 @@ def updateChangedCusipIsin(corporateActions):
             cusipIsinChanges[cusipIsinOld] = cusipIsinNew
 
 
-""" Gets the currency rate for a given date and currency. If no rate exists for a given
-    date, it returns the last value on the last previous day on which the rate exists
+""" Groups trades of the same security. Trades are added in buckets of the same identifier, first
+    all buckets by ISIN, then by CUSIP, securityID, conid and symbol. A bucket joins the first (in
+    order of creation) group that already holds a trade with the same identifier value, otherwise
+    it starts a new group keyed by the bucket identifier. The first group of every cusip,
+    securityID, conid and symbol value is indexed, so adding a bucket takes time proportional to
+    the number of its trades instead of scanning the trades of all groups. The same index is the
+    identity map used to key dividends by the group of their security.
+    Groups are ordered by the identifier type of the bucket that created them and then by creation,
+    so groups restored from an open lot snapshot and the groups of the new trades end up in the
+    same order as in a run over the full history.
 """
-def getCurrencyRate(dateStr, currency, rates):
-    if currency == "CNH":
-        currency = "CNY"
-    if dateStr in rates and currency in rates[dateStr]:
-        rate = float(rates[dateStr][currency])
-    else:
-        date = datetime.datetime.strptime(dateStr, "%Y%m%d")
-        for i in range(1, 10):
-            lastWorkingDate = date - datetime.timedelta(days=i)
-            lastWorkingDateStr = lastWorkingDate.strftime("%Y%m%d")
-            if lastWorkingDateStr in rates and currency in rates[lastWorkingDateStr]:
-                rate = float(rates[lastWorkingDateStr][currency])
-                print(
-                    "There is no exchange rate for "
-                    + str(dateStr)
-                    + ", using "
-                    + str(lastWorkingDateStr)
+class SecurityIdentityResolver:
+    bucketFields = ("isin", "cusip", "securityID", "conid", "symbol")
+    indexedFields = ("cusip", "securityID", "conid", "symbol")
+
+    def __init__(self):
+        """ Trades of every group by group key """
+        self.groups = {}
+        """ (rank of the identifier type, sequence number) of every group by group key """
+        self.groupOrder = {}
+        """ First group key of every indexed identifier value """
+        self.indexes = {field: {} for field in self.indexedFields}
+
+    def add(self, field, id, trades):
+        key = None
+        if field in self.indexes:
+            key = self.indexes[field].get(id)
+        if key is None and id in self.groups:
+            """ A bucket key equal to an existing group key (of a different identifier type) """
+            key = id
+        if key is None:
+            key = id
+            self.groups[id] = trades
+            self.groupOrder[id] = (self.bucketFields.index(field), len(self.groupOrder))
+        else:
+            self.groups[key] += trades
+
+        order = self.groupOrder[key]
+        for trade in trades:
+            for indexedField in self.indexedFields:
+                value = getattr(trade, indexedField)
+                if value is None:
+                    continue
+                index = self.indexes[indexedField]
+                if value not in index or self.groupOrder[index[value]] > order:
+                    index[value] = key
+
+    """ Returns the groups that hold trades, in order """
+    def getTrades(self):
+        return {
+            key: self.groups[key]
+            for key in sorted(self.groups, key=self.groupOrder.get)
+            if len(self.groups[key]) > 0
+        }
+
+    """ Returns the group keys in order with the identifier type that created them and the identity
+        map, to be stored in an open lot snapshot """
+    def getState(self):
+        return {
+            "groups": [
+                [key, self.bucketFields[self.groupOrder[key][0]]]
+                for key in sorted(self.groups, key=self.groupOrder.get)
+            ],
+            "identityMap": self.indexes,
+        }
+
+    """ Restores groups (without trades) and the identity map from an open lot snapshot, before any
+        trades are added. CUSIP/ISIN changes that were not known at the time of the snapshot are
+        applied to the restored identifiers.
+    """
+    def restoreState(self, state):
+        renamed = {}
+        for key, field in state["groups"]:
+            latestKey = key
+            if field in ("isin", "cusip"):
+                latestKey = getLatestCusipIsin(key)
+            renamed[key] = latestKey
+            if latestKey not in self.groups:
+                self.groups[latestKey] = []
+                self.groupOrder[latestKey] = (self.bucketFields.index(field), len(self.groupOrder))
+        for field in self.indexedFields:
+            for value, key in state["identityMap"][field].items():
+                if field == "cusip":
+                    value = getLatestCusipIsin(value)
+                self.indexes[field].setdefault(value, renamed.get(key, key))
+
+    """ Identity map of every cusip, securityID, conid and symbol value to its group key, by field """
+    @property
+    def identityMap(self):
+        return self.indexes
+
+    """ Returns the group key of a security by its identifiers, in the order of precedence, or None """
+    def resolve(self, isin=None, securityID=None, conid=None, symbol=None):
+        if isin in self.groups:
+            return isin
+        for field, value in [
+            ("securityID", securityID),
+            ("conid", conid),
+            ("symbol", symbol),
+        ]:
+            key = self.indexes[field].get(value)
+            if key is not None:
+                return key
+        return None
+
+
+""" Companies merged from companies-local.xml, the repo companies.xml and the local companies.xml.
+    Companies are first merged with add() and then sorted with sort(), which builds the indexes
+    used by find(). All merge and lookup rules of the former linear scans are kept: an incoming
+    company is merged into the first (in insertion order) matching company and find() prefers
+    the last (in symbol order) company matching the symbol, then conid, then isin.
+"""
+class CompanyRegistry:
+    def __init__(self):
+        self.companies = []
+        """ Merge indexes hold positions in self.companies. The first position of every isin,
+            conid and symbol and sorted positions of companies still missing isin or conid.
+        """
+        self.isinIndex = {}
+        self.conidIndex = {}
+        self.symbolIndex = {}
+        self.withoutIsinByConid = defaultdict(list)
+        self.withoutIsinBySymbolName = defaultdict(list)
+        self.withoutConidBySymbolName = defaultdict(list)
+        """ Lookup indexes, built by sort() """
+        self.byIsin = {}
+        self.byConid = {}
+        self.bySymbol = {}
+
+    def __iter__(self):
+        return iter(self.companies)
+
+    def __len__(self):
+        return len(self.companies)
+
+    """ Rebuilds a registry from companies that were already merged and sorted, e.g. the plain
+        list of company dicts kept in the snapshot. The indexes are rebuilt by sort().
+    """
+    @classmethod
+    def fromCompanies(cls, companies):
+        registry = cls()
+        registry.companies = companies
+        registry.sort()
+        return registry
+
+    @staticmethod
+    def indexFirst(index, key, position):
+        if key not in index or position < index[key]:
+            index[key] = position
+
+    """ Returns the first position in index[key] of a company whose field is still empty. Positions
+        of companies whose field has been set since are dropped on the way.
+    """
+    def firstWithout(self, index, key, field, empty):
+        positions = index.get(key)
+        while positions and self.companies[positions[0]][field] != empty:
+            del positions[0]
+        if positions:
+            return positions[0]
+        return None
+
+    def setIsin(self, position, isin):
+        self.companies[position]["isin"] = isin
+        self.indexFirst(self.isinIndex, isin, position)
+
+    def setConid(self, position, conid):
+        company = self.companies[position]
+        company["conid"] = conid
+        self.indexFirst(self.conidIndex, conid, position)
+        if company["isin"] == "":
+            bisect.insort(self.withoutIsinByConid[conid], position)
+
+    def append(self, company):
+        position = len(self.companies)
+        self.companies.append(company)
+        symbolName = (company["symbol"], company["name"])
+        if company["isin"] != "":
+            self.indexFirst(self.isinIndex, company["isin"], position)
+        else:
+            if company["conid"] is not None:
+                self.withoutIsinByConid[company["conid"]].append(position)
+            self.withoutIsinBySymbolName[symbolName].append(position)
+        if company["conid"] is not None:
+            self.indexFirst(self.conidIndex, company["conid"], position)
+        else:
+            self.withoutConidBySymbolName[symbolName].append(position)
+        self.indexFirst(self.symbolIndex, company["symbol"], position)
+
+    """ Merges a company into the registry. A company with isin is merged into the first company
+        with the same isin or, if missing isin, with the same conid or symbol and name. A company
+        with conid (and no isin) is merged into the first company with the same conid or, if
+        missing conid, with the same symbol and name. Other companies are merged by symbol.
+        Missing isin or conid of the matched company is taken from the merged company, unmatched
+        companies are added.
+    """
+    def add(self, company):
+        symbolName = (company["symbol"], company["name"])
+        if company["isin"] != "":
+            positions = [
+                self.isinIndex.get(company["isin"]),
+                self.firstWithout(self.withoutIsinBySymbolName, symbolName, "isin", ""),
+            ]
+            if company["conid"] is not None:
+                positions.append(
+                    self.firstWithout(
+                        self.withoutIsinByConid, company["conid"], "isin", ""
+                    )
                 )
+            positions = [p for p in positions if p is not None]
+            if positions:
+                position = min(positions)
+                if self.companies[position]["isin"] == "":
+                    self.setIsin(position, company["isin"])
+                return
+        elif company["conid"] is not None:
+            positions = [
+                p
+                for p in [
+                    self.conidIndex.get(company["conid"]),
+                    self.firstWithout(
+                        self.withoutConidBySymbolName, symbolName, "conid", None
+                    ),
+                ]
+                if p is not None
+            ]
+            if positions:
+                position = min(positions)
+                if self.companies[position]["conid"] is None:
+                    self.setConid(position, company["conid"])
+                return
+        elif company["symbol"] in self.symbolIndex:
+            return
+        self.append(company)
+
+    """ Sorts companies by symbol and builds the lookup indexes. Companies must not be added after. """
+    def sort(self):
+        self.companies.sort(key=lambda x: x["symbol"])
+        self.byIsin = {c["isin"]: c for c in self.companies if c["isin"] != ""}
+        self.byConid = {c["conid"]: c for c in self.companies if c["conid"] is not None}
+        self.bySymbol = {c["symbol"]: c for c in self.companies}
+
+    """ Returns the company of a security or None """
+    def find(self, isin, conid, symbol):
+        company = None
+        if isin is not None:
+            company = self.byIsin.get(isin)
+        company = self.byConid.get(conid, company)
+        return self.bySymbol.get(symbol, company)
+
+
+""" Exchange rates of all currencies as floats, forward filled over a dense index of calendar
+    days, so getting the rate for any (date, currency) is a single array lookup. If no rate exists
+    for a given date, the rate of the last previous day (at most maxFillDays back) on which the
+    rate exists is used. Rates are read from the rate store lazily, the column of a currency is
+    loaded and filled on first use.
+"""
+class RateTable:
+    maxFillDays = 9
+
+    def __init__(self, dbFilename):
+        self.db = sqlite3.connect(dbFilename)
+        firstDate, lastDate = self.db.execute(
+            "SELECT MIN(date), MAX(date) FROM rates"
+        ).fetchone()
+        firstDay = datetime.datetime.strptime(firstDate, "%Y%m%d").date()
+        lastDay = datetime.datetime.strptime(lastDate, "%Y%m%d").date()
+        days = (lastDay - firstDay).days + 1 + self.maxFillDays
+        self.dates = [
+            (firstDay + datetime.timedelta(days=i)).strftime("%Y%m%d")
+            for i in range(days)
+        ]
+        self.dayIndex = {date: i for i, date in enumerate(self.dates)}
+        self.columns = {}
+        self.reportedSubstitutes = set()
+
+    """ Builds the forward filled rate column of a currency together with the index of the day
+        each rate was taken from (-1 where there is no rate within maxFillDays) """
+    def getColumn(self, currency):
+        if currency not in self.columns:
+            rates = array.array("d", bytes(8 * len(self.dates)))
+            sources = array.array("l", [-1]) * len(self.dates)
+            for date, rate in self.db.execute(
+                "SELECT date, rate FROM rates WHERE currency = ?", (currency,)
+            ):
+                i = self.dayIndex[date]
+                rates[i] = rate
+                sources[i] = i
+            source = -1
+            for i in range(len(self.dates)):
+                if sources[i] == i:
+                    source = i
+                elif source >= 0 and i - source <= self.maxFillDays:
+                    rates[i] = rates[source]
+                    sources[i] = source
+            self.columns[currency] = (rates, sources)
+        return self.columns[currency]
+
+    """ Returns the rate for a date and currency or None if there is no rate within maxFillDays """
+    def findRate(self, dateStr, currency):
+        if currency == "CNH":
+            currency = "CNY"
+        rates, sources = self.getColumn(currency)
+        i = self.dayIndex.get(dateStr)
+        if i is None or sources[i] < 0:
+            return None
+        if sources[i] != i and (dateStr, sources[i]) not in self.reportedSubstitutes:
+            self.reportedSubstitutes.add((dateStr, sources[i]))
+            print(
+                "There is no exchange rate for "
+                + str(dateStr)
+                + ", using "
+                + self.dates[sources[i]]
+            )
+        return rates[i]
+
+    """ Converts a sequence of (date, currency, amount) items to EUR in a single pass and returns
+        a list of EUR amounts in the same order. The rate of every distinct (date, currency) is
+        looked up only once. If rates are missing, all the missing dates are reported together.
+    """
+    def convertToEUR(self, items):
+        items = list(items)
+        keyRates = {}
+        missingDates = set()
+        for date, currency, amount in items:
+            if currency == "EUR" or (date, currency) in keyRates:
+                continue
+            keyRates[(date, currency)] = self.findRate(date, currency)
+            if keyRates[(date, currency)] is None:
+                missingDates.add(date)
+        if missingDates:
+            sys.exit(
+                "Error: There is no exchange rate for " + ", ".join(sorted(missingDates))
+            )
+
+        return [
+            amount if currency == "EUR" else amount / keyRates[(date, currency)]
+            for date, currency, amount in items
+        ]
+
+
+""" Picks the entry whose description is the closest to a tax description when a tax cannot be
+    matched to a dividend or an interest by date, symbol and amount alone. Descriptions are
+    tokenised once into the parts that identify a payment (ISIN, amount per share, payment
+    type, interest period) and candidates are scored by the number of shared tokens. Only the
+    candidates that remain tied fall back to the longest common substring of the descriptions.
+    Tokens and scores are cached, so repeated comparisons of the same descriptions are free.
+"""
+class DescriptionMatcher:
+    isinPattern = re.compile(r"\b[A-Z]{2}[A-Z0-9]{9}[0-9]\b")
+    perSharePattern = re.compile(r"\b([A-Z]{3}) ([0-9]+(?:\.[0-9]+)?) PER SHARE\b")
+    periodPattern = re.compile(r"\bFOR ([A-Z]{3}-[0-9]{4})\b")
+    dividendTypePattern = re.compile(r"\(([A-Za-z ]+ Dividend)\)")
+    keywords = (
+        "CASH DIVIDEND",
+        "PAYMENT IN LIEU",
+        "RETURN OF CAPITAL",
+        "CHOICE DIVIDEND",
+        "CREDIT INT",
+        "DEBIT INT",
+        "BOND INTEREST",
+    )
+
+    def __init__(self):
+        self.tokens = {}
+        self.scores = {}
+        self.longestMatches = {}
+
+    def getTokens(self, description):
+        tokens = self.tokens.get(description)
+        if tokens is None:
+            tokens = set()
+            for isin in self.isinPattern.findall(description):
+                tokens.add(("isin", isin))
+            for currency, amount in self.perSharePattern.findall(description):
+                tokens.add(("perShare", currency, float(amount)))
+            for period in self.periodPattern.findall(description):
+                tokens.add(("period", period))
+            for dividendType in self.dividendTypePattern.findall(description):
+                tokens.add(("dividendType", dividendType))
+            for keyword in self.keywords:
+                if keyword in description:
+                    tokens.add(("keyword", keyword))
+            tokens = frozenset(tokens)
+            self.tokens[description] = tokens
+        return tokens
+
+    def getScore(self, taxDescription, description):
+        key = (taxDescription, description)
+        score = self.scores.get(key)
+        if score is None:
+            score = len(self.getTokens(taxDescription) & self.getTokens(description))
+            self.scores[key] = score
+        return score
+
+    def getLongestMatch(self, taxDescription, description):
+        key = (taxDescription, description)
+        size = self.longestMatches.get(key)
+        if size is None:
+            size = (
+                SequenceMatcher(None, taxDescription, description)
+                .find_longest_match(0, len(taxDescription), 0, len(description))
+                .size
+            )
+            self.longestMatches[key] = size
+        return size
+
+    """ Returns the candidate with the closest description, the first one on ties """
+    def findClosest(self, taxDescription, candidates, getDescription):
+        bestScore = max(
+            self.getScore(taxDescription, getDescription(candidate))
+            for candidate in candidates
+        )
+        tied = [
+            candidate
+            for candidate in candidates
+            if self.getScore(taxDescription, getDescription(candidate)) == bestScore
+        ]
+        closest = tied[0]
+        bestMatchLen = 0
+        if len(tied) > 1:
+            for candidate in tied:
+                size = self.getLongestMatch(taxDescription, getDescription(candidate))
+                if size > bestMatchLen:
+                    bestMatchLen = size
+                    closest = candidate
+        return closest
+
+
+""" dateTime is now the primary parameter, but old reports only have tradeDate and sometimes tradeTime """
+def getIbDateTime(attributes):
+    try:
+        dateTime = attributes["dateTime"].split(";")
+        date = dateTime[0]
+        time = dateTime[1]
+    except:
+        date = attributes["tradeDate"]
+        try:
+            time = attributes["tradeTime"]
+        except KeyError:
+            time = "000000"
+    return date, time
+
+
+""" Creates a Trade from flex Trade attributes. Stock splits and CUSIP/ISIN changes are applied
+    later, when corporate actions from all the reports are known.
+"""
+def createTrade(attributes):
+    date, time = getIbDateTime(attributes)
+    trade = Trade(
+        conid=sys.intern(attributes["conid"]),
+        symbol=sys.intern(attributes["symbol"]),
+        currency=sys.intern(attributes["currency"]),
+        assetCategory=sys.intern(attributes["assetCategory"]),
+        tradePrice=float(attributes["tradePrice"]),
+        quantity=float(attributes["quantity"]),
+        buySell=sys.intern(attributes["buySell"]),
+        tradeDate=date,
+        tradeTime=time,
+        transactionID=attributes["transactionID"],
+        ibOrderID=attributes["ibOrderID"],
+        openCloseIndicator=sys.intern(attributes["openCloseIndicator"]),
+        isin=internOrNone(attributes["isin"]),
+        cusip=internOrNone(attributes["cusip"]),
+        securityID=internOrNone(attributes["securityID"]),
+        description=internOrNone(attributes["description"]),
+        lots=[],
+    )
+    if "multiplier" in attributes:
+        trade.multiplier = float(attributes["multiplier"])
+    return trade
+
+
+def createLot(attributes):
+    date, time = getIbDateTime(attributes)
+    return Lot(
+        transactionID=attributes["transactionID"],
+        conid=sys.intern(attributes["conid"]),
+        symbol=sys.intern(attributes["symbol"]),
+        openDateTime=attributes["openDateTime"],
+        quantity=float(attributes["quantity"]),
+        date=date,
+        time=time,
+    )
+
+
+""" A single connection-pooled session is shared by all remote requests """
+httpSession = requests.Session()
+httpSession.headers["User-Agent"] = userAgent
+
+
+""" Downloads url and returns its content. Raises requests.exceptions.RequestException if the
+    server does not respond within fetchTimeout or returns an error status.
+"""
+def fetchUrl(url):
+    r = httpSession.get(url, timeout=fetchTimeout)
+    r.raise_for_status()
+    return r.content
+
+
+""" Downloads url into filename. If revalidate is False, an existing file is kept as it is (it may
+    contain local changes). Otherwise the ETag and Last-Modified headers of the download are
+    stored in cacheDir and sent back with the next request, so an unchanged file is answered with
+    304 Not Modified and is neither transferred nor rewritten. The file is replaced only with a
+    complete and valid XML, so if the download fails, the existing copy is kept.
+    Returns True if the file was updated.
+"""
+def fetchReferenceFile(url, filename, revalidate=True):
+    if os.path.isfile(filename) and not revalidate:
+        return False
+
+    metadataFilename = os.path.join(cacheDir, os.path.basename(filename) + ".http")
+    headers = {}
+    if os.path.isfile(filename):
+        try:
+            with open(metadataFilename) as f:
+                metadata = json.load(f)
+        except (OSError, ValueError):
+            metadata = {}
+        if metadata.get("etag"):
+            headers["If-None-Match"] = metadata["etag"]
+        if metadata.get("lastModified"):
+            headers["If-Modified-Since"] = metadata["lastModified"]
+
+    r = httpSession.get(url, headers=headers, timeout=fetchTimeout)
+    if r.status_code == 304:
+        return False
+    r.raise_for_status()
+    xml.etree.ElementTree.fromstring(r.content)
+
+    os.makedirs(cacheDir, exist_ok=True)
+    if os.path.dirname(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmpFilename = filename + "." + str(os.getpid()) + ".tmp"
+    with open(tmpFilename, "wb") as f:
+        f.write(r.content)
+    os.replace(tmpFilename, filename)
+    tmpMetadataFilename = metadataFilename + "." + str(os.getpid()) + ".tmp"
+    with open(tmpMetadataFilename, "w") as f:
+        json.dump(
+            {
+                "url": url,
+                "etag": r.headers.get("ETag"),
+                "lastModified": r.headers.get("Last-Modified"),
+            },
+            f,
+        )
+    os.replace(tmpMetadataFilename, metadataFilename)
+    return True
+
+
+""" Parses a Bank of Slovenia exchange rate list into (date, currency, rate) rows """
+def parseBsRateXml(content):
+    rows = []
+    for d in xml.etree.ElementTree.fromstring(content):
+        date = d.attrib["datum"].replace("-", "")
+        for r in d:
+            rows.append((date, r.attrib["oznaka"], float(r.text)))
+    return rows
+
+
+""" Fetches exchange rates of the days after lastDate. If the latest day in the short daily list
+    directly follows lastDate (no working day was skipped), the full list is not downloaded.
+"""
+def fetchBsRates(lastDate):
+    if lastDate is not None:
+        rows = [row for row in parseBsRateXml(fetchUrl(bsRateDailyXmlUrl)) if row[0] > lastDate]
+        if len(rows) == 0:
+            return rows
+        day = datetime.datetime.strptime(lastDate, "%Y%m%d").date()
+        dailyDay = datetime.datetime.strptime(min(row[0] for row in rows), "%Y%m%d").date()
+        while day + datetime.timedelta(days=1) < dailyDay:
+            day += datetime.timedelta(days=1)
+            if day.weekday() < 5:
                 break
-            if i >= 9:
-                sys.exit("Error: There is no exchange rate for " + str(dateStr))
-    return rate
+        else:
+            return rows
+
+    return [
+        row
+        for row in parseBsRateXml(fetchUrl(bsRateXmlUrl))
+        if lastDate is None or row[0] > lastDate
+    ]
+
+
+""" Updates the local bsRateDbFilename store of Bank of Slovenia exchange rates. Past rates never
+    change, so the store keeps the whole history and is extended at most once a day with the days
+    that are newer than its last entry. Rates are read from the store by RateTable.
+"""
+def updateBsRates():
+    db = sqlite3.connect(bsRateDbFilename)
+    with db:
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS rates (date TEXT, currency TEXT, rate REAL,"
+            " PRIMARY KEY (date, currency)) WITHOUT ROWID"
+        )
+        db.execute(
+            "CREATE INDEX IF NOT EXISTS ratesByCurrency ON rates (currency, date)"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)"
+        )
+
+    today = datetime.date.today().strftime("%Y%m%d")
+    lastUpdate = db.execute(
+        "SELECT value FROM metadata WHERE key = 'lastUpdate'"
+    ).fetchone()
+    if lastUpdate is None or lastUpdate[0] != today:
+        lastDate = db.execute("SELECT MAX(date) FROM rates").fetchone()[0]
+        try:
+            rows = fetchBsRates(lastDate)
+        except (
+            requests.exceptions.RequestException,
+            xml.etree.ElementTree.ParseError,
+        ) as e:
+            if lastDate is None:
+                raise
+            print(
+                "Could not update exchange rates ("
+                + str(e)
+                + "), using stored rates up to "
+                + lastDate
+            )
+        else:
+            with db:
+                db.executemany("INSERT OR REPLACE INTO rates VALUES (?, ?, ?)", rows)
+                db.execute(
+                    "INSERT OR REPLACE INTO metadata VALUES ('lastUpdate', ?)", (today,)
+                )
+
+    db.close()
+
+    """ Remove daily rate files downloaded by older versions """
+    for file in glob.glob("bsrate-*.xml"):
+        os.remove(file)
+
+
+""" Local copy of the repo companies.xml (the companies.xml in the working directory holds the
+    merged data)
+"""
+companiesRepoFilename = os.path.join(cacheDir, "companies.xml")
+
+
+""" Fetches all remote reference data concurrently in a thread pool, so startup takes as long as
+    the slowest fetch instead of the sum of them. Failed downloads are reported once all fetches
+    are done and the cached copies are used instead. ib-affiliates.xml may be edited locally, so
+    it is only fetched if it doesn't exist. The exchange rate store is updated alongside.
+"""
+def fetchReferenceData():
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        fileFutures = [
+            (url, filename, executor.submit(fetchReferenceFile, url, filename, revalidate))
+            for url, filename, revalidate in [
+                (companiesXmlUrl, companiesRepoFilename, True),
+                (reliefStatementsXmlUrl, "relief-statements.xml", True),
+                (ibAffiliatesXmlUrl, "ib-affiliates.xml", False),
+            ]
+        ]
+        bsRatesFuture = executor.submit(updateBsRates)
+
+    for url, filename, future in fileFutures:
+        try:
+            future.result()
+        except (
+            requests.exceptions.RequestException,
+            xml.etree.ElementTree.ParseError,
+            OSError,
+        ) as e:
+            print(
+                "Could not fetch "
+                + url
+                + " ("
+                + str(e)
+                + ")"
+                + (", using the existing " + filename if os.path.isfile(filename) else "")
+            )
+
+    bsRatesFuture.result()
+
+
+""" Sources of companies, in the order of precedence. The local companies.xml is also the output
+    of the merge.
+"""
+companiesSourceFilenames = ["companies-local.xml", companiesRepoFilename, "companies.xml"]
+companiesSnapshotFilename = os.path.join(cacheDir, "companies.pickle")
+
+
+""" Returns the hash of all the companies sources """
+def getCompaniesSnapshotKey():
+    sourcesHash = hashlib.sha256(str(companiesCacheVersion).encode())
+    for filename in companiesSourceFilenames:
+        try:
+            with open(filename, "rb") as f:
+                sourcesHash.update(hashlib.sha256(f.read()).digest())
+        except OSError:
+            sourcesHash.update(b"missing")
+    return sourcesHash.hexdigest()
+
+
+""" Merges companies from companies-local.xml, the repo companies.xml and the local companies.xml
+    into a CompanyRegistry and writes them to the local companies.xml if they changed. The merged
+    registry is kept in a snapshot in cacheDir together with the hash of the sources, so as long
+    as no source changes, the snapshot is loaded instead of parsing and merging the sources.
+"""
+def loadCompanies():
+    if not os.path.isfile("companies-local.xml"):
+        with open("companies-local.xml", "w") as f:
+            f.write("<companies>\n\n</companies>")
+
+    snapshotKey = getCompaniesSnapshotKey()
+    try:
+        with open(companiesSnapshotFilename, "rb") as f:
+            key, snapshotCompanies = pickle.load(f)
+        if key == snapshotKey:
+            return CompanyRegistry.fromCompanies(snapshotCompanies)
+    except Exception:
+        pass
+
+    companies = CompanyRegistry()
+    companiesXmls = []
+    try:
+        companiesXmls.append(xml.etree.ElementTree.parse("companies-local.xml").getroot())
+    except:
+        pass
+    try:
+        companiesXmls.append(xml.etree.ElementTree.parse(companiesRepoFilename).getroot())
+    except:
+        pass
+
+    """ To ease the transition from companies.xml to companies-local.xml we will keep local changes to companies.xml for now.
+        This part of code wil be removed later. """
+    try:
+        companiesXmls.append(xml.etree.ElementTree.parse("companies.xml").getroot())
+    except:
+        pass
+
+    for cs in companiesXmls:
+        for company in cs:
+            c = {
+                "isin": "",
+                "symbol": company.find("symbol").text.strip(),
+                "name": company.find("name").text.strip(),
+                "taxNumber": "",
+                "address": company.find("address").text.strip(),
+                "country": company.find("country").text.strip(),
+                "conid": None,
+            }
+            if company.find("isin") is not None and company.find("isin").text is not None:
+                c["isin"] = company.find("isin").text.strip()
+            if company.find("taxNumber") is not None and company.find("taxNumber").text is not None:
+                c["taxNumber"] = company.find("taxNumber").text.strip()
+            if company.find("conid") is not None and company.find("conid").text is not None:
+                c["conid"] = company.find("conid").text.strip()
+            companies.add(c)
+    if len(companies) > 0:
+        companies.sort()
+        cs = xml.etree.ElementTree.Element("companies")
+        for company in companies:
+            c = xml.etree.ElementTree.SubElement(cs, "company")
+            xml.etree.ElementTree.SubElement(c, "isin").text = company["isin"]
+            if company["conid"] is not None and company["conid"] != "":
+                xml.etree.ElementTree.SubElement(c, "conid").text = company["conid"]
+            xml.etree.ElementTree.SubElement(c, "symbol").text = company["symbol"]
+            xml.etree.ElementTree.SubElement(c, "name").text = company["name"]
+            xml.etree.ElementTree.SubElement(c, "taxNumber").text = company["taxNumber"]
+            xml.etree.ElementTree.SubElement(c, "address").text = company["address"]
+            xml.etree.ElementTree.SubElement(c, "country").text = company["country"]
+        tree = xml.etree.ElementTree.ElementTree(cs)
+        xml.etree.ElementTree.indent(tree)
+        content = xml.etree.ElementTree.tostring(cs)
+        try:
+            with open("companies.xml", "rb") as f:
+                changed = f.read() != content
+        except OSError:
+            changed = True
+        if changed:
+            tmpFilename = "companies.xml." + str(os.getpid()) + ".tmp"
+            with open(tmpFilename, "wb") as f:
+                f.write(content)
+            os.replace(tmpFilename, "companies.xml")
+
+    try:
+        os.makedirs(cacheDir, exist_ok=True)
+        tmpFilename = companiesSnapshotFilename + "." + str(os.getpid()) + ".tmp"
+        with open(tmpFilename, "wb") as f:
+            pickle.dump(
+                (getCompaniesSnapshotKey(), companies.companies),
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        os.replace(tmpFilename, companiesSnapshotFilename)
+    except OSError as e:
+        print("Could not write " + companiesSnapshotFilename + " (" + str(e) + ")")
+
+    return companies
+
+
+""" Returns relief statements from relief-statements.xml (fetched from GitHub) indexed by country,
+    later statements of the same country take precedence
+"""
+def loadReliefStatements():
+    reliefStatements = {}
+    if os.path.isfile("relief-statements.xml"):
+        statements = xml.etree.ElementTree.parse("relief-statements.xml").getroot()
+        for statement in statements:
+            reliefStatements[statement.find("country").text] = statement.find(
+                "statement"
+            ).text
+    return reliefStatements
+
+
+""" Relief statements by country for all the reports of a run. relief-statements.xml is parsed on
+    the first lookup, so runs without dividends of known companies never parse it.
+"""
+class ReliefStatements:
+    def __init__(self):
+        self.byCountry = None
+
+    """ Returns the relief statement of a country or None """
+    def find(self, country):
+        if self.byCountry is None:
+            self.byCountry = loadReliefStatements()
+        return self.byCountry.get(country)
+
+
+""" Schema of the transaction ledger. Records keep their raw values from IB XML (before splits and
+    CUSIP/ISIN changes) and are kept in the order of import (seq), grouped by the flex statement
+    that first contained them, so reports from the ledger are the same as from IB XML files.
+"""
+ledgerSchema = """
+CREATE TABLE IF NOT EXISTS statements (seq INTEGER PRIMARY KEY, accountId TEXT, source TEXT);
+CREATE TABLE IF NOT EXISTS accounts (accountId TEXT PRIMARY KEY, ibEntity TEXT);
+CREATE TABLE IF NOT EXISTS trades (
+    seq INTEGER PRIMARY KEY, statement INTEGER, transactionID TEXT UNIQUE, conid TEXT,
+    symbol TEXT, currency TEXT, assetCategory TEXT, tradePrice REAL, quantity REAL,
+    multiplier REAL, buySell TEXT, tradeDate TEXT, tradeTime TEXT, ibOrderID TEXT,
+    openCloseIndicator TEXT, isin TEXT, cusip TEXT, securityID TEXT, description TEXT
+);
+CREATE INDEX IF NOT EXISTS tradesConid ON trades (conid);
+CREATE INDEX IF NOT EXISTS tradesIsin ON trades (isin);
+CREATE INDEX IF NOT EXISTS tradesDate ON trades (tradeDate);
+CREATE INDEX IF NOT EXISTS tradesOrder ON trades (ibOrderID);
+CREATE TABLE IF NOT EXISTS lots (
+    seq INTEGER PRIMARY KEY, tradeTransactionID TEXT, transactionID TEXT, conid TEXT,
+    symbol TEXT, openDateTime TEXT, quantity REAL, date TEXT, time TEXT
+);
+CREATE INDEX IF NOT EXISTS lotsTrade ON lots (tradeTransactionID);
+CREATE INDEX IF NOT EXISTS lotsConid ON lots (conid);
+CREATE TABLE IF NOT EXISTS cashTransactions (
+    seq INTEGER PRIMARY KEY, statement INTEGER, transactionID TEXT UNIQUE, type TEXT,
+    dateTime TEXT, conid TEXT, attributes TEXT
+);
+CREATE INDEX IF NOT EXISTS cashTransactionsDate ON cashTransactions (dateTime);
+CREATE INDEX IF NOT EXISTS cashTransactionsConid ON cashTransactions (conid);
+CREATE TABLE IF NOT EXISTS corporateActions (
+    seq INTEGER PRIMARY KEY, statement INTEGER, conid TEXT, dateTime TEXT, description TEXT,
+    attributes TEXT, UNIQUE (conid, dateTime, description)
+);
+"""
+ledgerTradeFields = [
+    "transactionID", "conid", "symbol", "currency", "assetCategory", "tradePrice", "quantity",
+    "multiplier", "buySell", "tradeDate", "tradeTime", "ibOrderID", "openCloseIndicator",
+    "isin", "cusip", "securityID", "description",
+]
+ledgerLotFields = [
+    "transactionID", "conid", "symbol", "openDateTime", "quantity", "date", "time",
+]
+
+
+""" Imports flex statements into a ledger. Trades (with their lots) and cash transactions are
+    deduplicated by transactionID and corporate actions by conid, date and description, so
+    overlapping or repeatedly imported IB XML files add only new records.
+"""
+def importIntoLedger(db, source, ibFlexStatements):
+    for ibFlexStatement in ibFlexStatements:
+        statement = db.execute(
+            "INSERT INTO statements (accountId, source) VALUES (?, ?)",
+            (ibFlexStatement["accountId"], source),
+        ).lastrowid
+        added = 0
+        for trade in ibFlexStatement["trades"]:
+            cursor = db.execute(
+                "INSERT OR IGNORE INTO trades (statement, "
+                + ", ".join(ledgerTradeFields)
+                + ") VALUES (?"
+                + ", ?" * len(ledgerTradeFields)
+                + ")",
+                [statement] + [getattr(trade, field) for field in ledgerTradeFields],
+            )
+            if cursor.rowcount == 1:
+                added += 1
+                db.executemany(
+                    "INSERT INTO lots (tradeTransactionID, "
+                    + ", ".join(ledgerLotFields)
+                    + ") VALUES (?"
+                    + ", ?" * len(ledgerLotFields)
+                    + ")",
+                    [
+                        [trade.transactionID] + [getattr(lot, field) for field in ledgerLotFields]
+                        for lot in trade.lots
+                    ],
+                )
+        for ibCashTransaction in ibFlexStatement["cashTransactions"]:
+            """ Ignore levelOfDetail="SUMMARY" CashTransactions """
+            if ibCashTransaction["transactionID"] == "":
+                continue
+            added += db.execute(
+                "INSERT OR IGNORE INTO cashTransactions (statement, transactionID, type, dateTime,"
+                " conid, attributes) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    statement,
+                    ibCashTransaction["transactionID"],
+                    ibCashTransaction.get("type"),
+                    ibCashTransaction.get("dateTime"),
+                    ibCashTransaction.get("conid"),
+                    json.dumps(ibCashTransaction),
+                ),
+            ).rowcount
+        for action in ibFlexStatement["corporateActions"]:
+            added += db.execute(
+                "INSERT OR IGNORE INTO corporateActions (statement, conid, dateTime, description,"
+                " attributes) VALUES (?, ?, ?, ?, ?)",
+                (
+                    statement,
+                    action.get("conid"),
+                    action.get("dateTime"),
+                    action.get("description"),
+                    json.dumps(action),
+                ),
+            ).rowcount
+        accountInformation = ibFlexStatement["accountInformation"]
+        if accountInformation is not None:
+            added += db.execute(
+                "INSERT OR IGNORE INTO accounts VALUES (?, ?)",
+                (accountInformation["accountId"], accountInformation["ibEntity"]),
+            ).rowcount
+        if added == 0:
+            db.execute("DELETE FROM statements WHERE seq = ?", (statement,))
+
+
+""" Returns all flex statements from a ledger, in the same form as loadIbXml """
+def loadLedgerStatements(db):
+    accounts = {}
+    for accountId, ibEntity in db.execute("SELECT accountId, ibEntity FROM accounts"):
+        accounts[accountId] = {"accountId": accountId, "ibEntity": ibEntity}
+    ibFlexStatements = {}
+    for seq, accountId in db.execute("SELECT seq, accountId FROM statements ORDER BY seq"):
+        ibFlexStatements[seq] = {
+            "accountId": accountId,
+            "accountInformation": accounts.get(accountId),
+            "trades": [],
+            "cashTransactions": [],
+            "corporateActions": [],
+        }
+
+    tradesByTransactionID = {}
+    for row in db.execute(
+        "SELECT statement, " + ", ".join(ledgerTradeFields) + " FROM trades ORDER BY seq"
+    ):
+        trade = Trade(**dict(zip(ledgerTradeFields, row[1:])), lots=[])
+        for field in ("conid", "symbol", "currency", "assetCategory", "buySell", "openCloseIndicator"):
+            setattr(trade, field, sys.intern(getattr(trade, field)))
+        tradesByTransactionID[trade.transactionID] = trade
+        ibFlexStatements[row[0]]["trades"].append(trade)
+    for row in db.execute(
+        "SELECT tradeTransactionID, " + ", ".join(ledgerLotFields) + " FROM lots ORDER BY seq"
+    ):
+        tradesByTransactionID[row[0]].lots.append(Lot(**dict(zip(ledgerLotFields, row[1:]))))
+
+    for statement, attributes in db.execute(
+        "SELECT statement, attributes FROM cashTransactions ORDER BY seq"
+    ):
+        ibFlexStatements[statement]["cashTransactions"].append(json.loads(attributes))
+    for statement, attributes in db.execute(
+        "SELECT statement, attributes FROM corporateActions ORDER BY seq"
+    ):
+        ibFlexStatements[statement]["corporateActions"].append(json.loads(attributes))
+
+    return list(ibFlexStatements.values())
+
+
+""" Imports parsed IB XML files (pairs of filename and flex statements) into the ledger in
+    ledgerFilename and returns all the flex statements in the ledger
+"""
+def loadLedger(ledgerFilename, ibXmls):
+    db = sqlite3.connect(ledgerFilename)
+    with db:
+        db.executescript(ledgerSchema)
+    with db:
+        for ibXmlFilename, ibFlexStatements in ibXmls:
+            importIntoLedger(db, os.path.basename(ibXmlFilename), ibFlexStatements)
+    ibFlexStatements = loadLedgerStatements(db)
+    db.close()
+    return ibFlexStatements
+
+
+""" Open lot snapshots are JSON files with opening trades that are not (fully) closed at the end
+    of a year, with the quantity that is still open (closing trades take quantities from their lots).
+    Trades are stored after splits, CUSIP/ISIN changes and conversion to EUR were applied,
+    together with the splits (by conid) and CUSIP/ISIN changes that were known at the time, so that
+    the run of the next year only needs IB XML files of the next year.
+    The groups of securities (in order) and their identity map are stored as well, so the reports of
+    the next year list securities in the same order as a run over the full history. Only trades that
+    can be matched as opening trades of a closing trade are stored, closing and opening trades and
+    trades of skipped asset categories are only listed by transactionID (with the quantity that is
+    still open), so that closing trades
+    referencing them are skipped the same way as in a run over the full history.
+"""
+openLotSnapshotFields = [
+    field for field in Trade.__slots__ if field not in ("lots", "openTransactionIds")
+]
+
+
+""" Exports opening (and closing and opening) trades up to the end of snapshotYear that are not fully
+    closed by then
+"""
+def exportOpenLotSnapshot(
+    filename, snapshotYear, tradesByTransactionID, unmatchedQuantities, securityIdentities
+):
+    lastDate = str(snapshotYear) + "1231"
+    closedQuantities = defaultdict(float)
+    for trade in tradesByTransactionID.values():
+        if trade.openTransactionIds is not None and trade.tradeDate <= lastDate:
+            for tid in trade.openTransactionIds:
+                closedQuantities[tid] += trade.openTransactionIds[tid].quantity
+
+    openTrades = []
+    """ Unmatched trades from the snapshot this run started from are carried over while still open """
+    unmatchedOpenQuantities = {}
+    for tid in unmatchedQuantities:
+        openQuantity = unmatchedQuantities[tid] - closedQuantities[tid]
+        if abs(openQuantity) > 1e-9 * abs(unmatchedQuantities[tid]):
+            unmatchedOpenQuantities[tid] = openQuantity
+    conids = set()
+    for trade in tradesByTransactionID.values():
+        if trade.openCloseIndicator not in ("O", "C;O") or trade.tradeDate > lastDate:
+            continue
+        openQuantity = trade.quantity - closedQuantities[trade.transactionID]
+        if trade.openCloseIndicator == "C;O" and trade.openTransactionIds is not None:
+            """ Only the part of the trade above the closed lots opened a position """
+            for tid in trade.openTransactionIds:
+                openQuantity += trade.openTransactionIds[tid].quantity
+        if abs(openQuantity) <= 1e-9 * abs(trade.quantity):
+            continue
+        if (
+            trade.openCloseIndicator != "O"
+            or trade.assetType is None
+            or trade.tradePriceEUR is None
+        ):
+            unmatchedOpenQuantities[trade.transactionID] = openQuantity
+            continue
+        openTrade = {field: getattr(trade, field) for field in openLotSnapshotFields}
+        openTrade["quantity"] = openQuantity
+        openTrades.append(openTrade)
+        conids.add(trade.conid)
+
+    snapshot = {
+        "version": openLotSnapshotVersion,
+        "year": snapshotYear,
+        "trades": sorted(
+            openTrades,
+            key=lambda t: (t["tradeDate"], t["tradeTime"], t["transactionID"]),
+        ),
+        "splits": {
+            conid: sorted(stockSplits[conid])
+            for conid in sorted(conids)
+            if stockSplits.get(conid)
+        },
+        "cusipIsinChanges": cusipIsinChanges,
+        "unmatchedQuantities": dict(sorted(unmatchedOpenQuantities.items())),
+        "securityGroups": securityIdentities.getState(),
+    }
+    with open(filename, "w", encoding="utf-8") as f:
+        json.dump(snapshot, f, indent=1)
+    print(
+        "Open lot snapshot %s created (includes %d open lots at the end of %d)"
+        % (filename, len(openTrades), snapshotYear)
+    )
+
+
+""" Returns open trades, splits by conid, CUSIP/ISIN changes, open quantities of trades that are not
+    matched by transactionID and the state of the groups of securities from an open lot snapshot
+"""
+def loadOpenLotSnapshot(filename):
+    with open(filename, encoding="utf-8") as f:
+        snapshot = json.load(f)
+    if snapshot.get("version") != openLotSnapshotVersion:
+        sys.exit("Error: " + filename + " is not a supported open lot snapshot")
+    trades = [Trade(**trade) for trade in snapshot["trades"]]
+    splits = {
+        conid: set((timestamp, multiplier) for timestamp, multiplier in snapshot["splits"][conid])
+        for conid in snapshot["splits"]
+    }
+    return (
+        trades,
+        splits,
+        snapshot["cusipIsinChanges"],
+        snapshot["unmatchedQuantities"],
+        snapshot["securityGroups"],
+    )
+
+
+""" Applies splits and CUSIP/ISIN changes that were not known when the snapshot was exported """
+def applySnapshotChanges(trade, appliedSplits):
+    if trade.isin is not None:
+        trade.isin = getLatestCusipIsin(trade.isin)
+    if trade.cusip is not None:
+        trade.cusip = getLatestCusipIsin(trade.cusip)
+
+    timestamp = int(trade.tradeDate + trade.tradeTime)
+    splitMultiplier = 1
+    for splitTimestamp, multiplier in sorted(stockSplits.get(trade.conid, ())):
+        if splitTimestamp > timestamp and (splitTimestamp, multiplier) not in appliedSplits:
+            splitMultiplier *= multiplier
+    trade.quantity *= splitMultiplier
+    trade.tradePrice /= splitMultiplier
+    if trade.tradePriceEUR is not None:
+        trade.tradePriceEUR /= splitMultiplier
+
+
+cashTransactionKinds = ("dividends", "dividendTaxes", "interests", "interestTaxes")
+
+""" Routes the cash transactions of the report years into buckets by kind in a single pass and
+    returns {year: [{kind: [(date, ibCashTransaction), ...]}, ...]} with a dict of buckets per
+    flex statement. Summary rows and cash transactions of other types are left out. Dividends
+    share a bucket with payments in lieu of dividends and interest with broker fees, as the
+    reports depend on the order of those entries. Withholding taxes with a conid are taxes on
+    dividends, those without one are taxes on interest.
+"""
+def classifyCashTransactions(ibCashTransactionsList, reportYears):
+    cashTransactionsByYear = {
+        str(reportYear): [
+            {kind: [] for kind in cashTransactionKinds}
+            for ibCashTransactions in ibCashTransactionsList
+        ]
+        for reportYear in reportYears
+    }
+    for i, ibCashTransactions in enumerate(ibCashTransactionsList):
+        for ibCashTransaction in ibCashTransactions:
+            """ Ignore levelOfDetail="SUMMARY" CashTransactions """
+            if ibCashTransaction["transactionID"] == "":
+                continue
+            yearCashTransactions = cashTransactionsByYear.get(
+                ibCashTransaction["dateTime"][0:4]
+            )
+            if yearCashTransactions is None:
+                continue
+            type = ibCashTransaction["type"]
+            if type in ("Dividends", "Payment In Lieu Of Dividends"):
+                kind = "dividends"
+            elif type == "Withholding Tax":
+                if ibCashTransaction["conid"] != "":
+                    kind = "dividendTaxes"
+                else:
+                    kind = "interestTaxes"
+            elif type in ("Broker Interest Received", "Broker Fees"):
+                kind = "interests"
+            else:
+                continue
+            yearCashTransactions[i][kind].append(
+                (ibCashTransaction["dateTime"][0:8], ibCashTransaction)
+            )
+    return cashTransactionsByYear
+
+
+""" Parses the -y argument: a year, a range of years (2021-2024) or a comma separated list of both """
+def parseReportYears(value):
+    reportYears = set()
+    for part in value.split(","):
+        bounds = part.strip().split("-")
+        try:
+            firstYear = int(bounds[0])
+            lastYear = int(bounds[-1])
+        except ValueError:
+            raise argparse.ArgumentTypeError("invalid report year: " + value)
+        if len(bounds) > 2 or firstYear > lastYear:
+            raise argparse.ArgumentTypeError("invalid report year range: " + part)
+        reportYears.update(range(firstYear, lastYear + 1))
+    return sorted(reportYears)
+
+
+""" Returns the filename of a form, with the report year appended if reports for multiple years
+    are generated in a single run
+"""
+def getReportFilename(form, reportYear, multipleYears):
+    if multipleYears:
+        return form + "-" + str(reportYear) + ".xml"
+    return form + ".xml"
+
+
+""" Flex statement sections and the record tags that are extracted from them """
+ibXmlSections = {
+    "Trades": ("trades", ("Trade", "Lot")),
+    "CashTransactions": ("cashTransactions", ("CashTransaction",)),
+    "CorporateActions": ("corporateActions", ("CorporateAction",)),
+}
+
+
+""" Streams an IB flex XML file with iterparse and returns a list of flex statements, each
+    holding only the Trade/Lot, CashTransaction and CorporateAction records and the account
+    information. Every other element is cleared as soon as it is parsed and every section is
+    detached from the tree once consumed, so the whole report is never kept in memory.
+    Trades are kept as Trade records with their Lots attached, other records as plain attribute
+    dicts, which keeps the result compact and cheap to pass between processes.
+"""
+def parseIbXml(ibXmlFilename):
+    ibFlexStatements = []
+    ibFlexStatement = None
+    section = None
+    lastTrade = None
+    for event, element in xml.etree.ElementTree.iterparse(
+        ibXmlFilename, events=("start", "end")
+    ):
+        if event == "start":
+            if element.tag == "FlexStatement":
+                ibFlexStatement = {
+                    "accountId": element.get("accountId"),
+                    "accountInformation": None,
+                    "trades": [],
+                    "cashTransactions": [],
+                    "corporateActions": [],
+                }
+            elif ibFlexStatement is not None and section is None:
+                section = element
+            continue
+
+        if element is section:
+            if element.tag == "AccountInformation":
+                ibFlexStatement["accountInformation"] = {
+                    "accountId": element.get("accountId"),
+                    "ibEntity": element.get("ibEntity"),
+                }
+            section = None
+            element.clear()
+        elif section is not None:
+            key, recordTags = ibXmlSections.get(section.tag, (None, ()))
+            if element.tag not in recordTags:
+                element.clear()
+            elif key == "trades":
+                if element.attrib["assetCategory"] not in ignoreAssets:
+                    if element.tag == "Trade":
+                        lastTrade = createTrade(element.attrib)
+                        ibFlexStatement[key].append(lastTrade)
+                    elif lastTrade is not None:
+                        """ Lot tag (corresponding open transaction reference) """
+                        lastTrade.lots.append(createLot(element.attrib))
+                element.clear()
+            else:
+                ibFlexStatement[key].append(element.attrib)
+        elif element.tag == "FlexStatement":
+            ibFlexStatements.append(ibFlexStatement)
+            ibFlexStatement = None
+            element.clear()
+
+    return ibFlexStatements
+
+
+""" Returns parsed flex statements of an IB flex XML file. Parsed statements are cached in
+    cacheDir under the hash of the file contents, so unchanged files (i.e. reports for
+    closed years) are parsed only once and loaded from the cache on subsequent runs.
+"""
+def loadIbXml(ibXmlFilename, useCache=True):
+    if not useCache:
+        return parseIbXml(ibXmlFilename)
+
+    fileHash = hashlib.sha256(str(ibXmlCacheVersion).encode())
+    with open(ibXmlFilename, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            fileHash.update(chunk)
+    cacheFilename = os.path.join(cacheDir, fileHash.hexdigest() + ".pickle")
+
+    if os.path.isfile(cacheFilename):
+        try:
+            with open(cacheFilename, "rb") as f:
+                return pickle.load(f)
+        except Exception:
+            print("Cache file " + cacheFilename + " is corrupt, parsing " + ibXmlFilename)
+
+    ibFlexStatements = parseIbXml(ibXmlFilename)
+    try:
+        os.makedirs(cacheDir, exist_ok=True)
+        """ Write to a temporary file first, parallel runs must never see a partial cache file """
+        tmpFilename = cacheFilename + "." + str(os.getpid()) + ".tmp"
+        with open(tmpFilename, "wb") as f:
+            pickle.dump(ibFlexStatements, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpFilename, cacheFilename)
+    except OSError as e:
+        print("Could not cache parsed " + ibXmlFilename + ": " + str(e))
+    return ibFlexStatements
 
 
 def main():
@@ -150,14 +1491,14 @@ def main():
         "ibXmlFiles",
         metavar="ib-xml-file",
         help="InteractiveBrokers XML output file(s) (see README.md on how to generate one)",
-        nargs="+",
+        nargs="*",
     )
     parser.add_argument(
         "-y",
         metavar="report-year",
-        type=int,
-        default=0,
-        help="Report will be generated for the provided calendar year (defaults to "
+        type=parseReportYears,
+        default=None,
+        help="Report will be generated for the provided calendar year, a range (2021-2024) or a comma separated list of years (defaults to "
         + str(datetime.date.today().year - 1)
         + ")",
     )
@@ -166,22 +1507,47 @@ def main():
         help="Change trade dates to previous year (see README.md)",
         action="store_true",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        metavar="N",
+        type=int,
+        default=1,
+        help="Parse IB XML files in N parallel processes (defaults to 1)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        help="Always parse IB XML files, do not use or update the cache of parsed files",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--ledger",
+        metavar="ledger-file",
+        help="Import IB XML files into a SQLite ledger and generate reports from all the transactions in the ledger",
+    )
+    parser.add_argument(
+        "--snapshot",
+        metavar="snapshot-file",
+        help="Use open lots from a snapshot exported by a previous run, so only IB XML files of the following years are needed",
+    )
+    parser.add_argument(
+        "--export-snapshot",
+        metavar="snapshot-file",
+        help="Export lots that are still open at the end of the (last) report year to a snapshot file",
+    )
 
     args = parser.parse_args()
+    if len(args.ibXmlFiles) == 0 and args.ledger is None:
+        parser.error("at least one ib-xml-file is required")
     ibXmlFilenames = args.ibXmlFiles
     test = args.t
-    if args.y == 0:
+    if args.y is None:
         if test == True:
-            reportYear = datetime.date.today().year
+            reportYears = [datetime.date.today().year]
         else:
-            reportYear = datetime.date.today().year - 1
+            reportYears = [datetime.date.today().year - 1]
     else:
-        reportYear = int(args.y)
-
-    if test == True:
-        testYearDiff = reportYear - datetime.date.today().year - 1
-    else:
-        testYearDiff = 0
+        reportYears = args.y
 
     """ Parse taxpayer information from the local taxpayer.xml file """
     taxpayer = xml.etree.ElementTree.parse("taxpayer.xml").getroot()
@@ -199,178 +1565,75 @@ def main():
         "isResident": taxpayer.find("isResident").text,
     }
 
-    """ Merge data from local companies-local.xml and repo companies.xml into local companies.xml """
-    companies = []
-    companiesXmls = []
-    if not os.path.isfile("companies-local.xml"):
-        with open("companies-local.xml", "w") as f:
-            f.write("<companies>\n\n</companies>")
-    try:
-        companiesXmls.append(xml.etree.ElementTree.parse("companies-local.xml").getroot())
-    except:
-        pass
-    try:
-        r = requests.get("https://github.com/jamsix/ib-edavki/raw/master/companies.xml", headers={"User-Agent": userAgent})
-        companiesXmls.append(xml.etree.ElementTree.ElementTree(xml.etree.ElementTree.fromstring(r.content)).getroot())
-    except:
-        pass
-
-    """ To ease the transition from companies.xml to companies-local.xml we will keep local changes to companies.xml for now.
-        This part of code wil be removed later. """
-    try:
-        companiesXmls.append(xml.etree.ElementTree.parse("companies.xml").getroot())
-    except:
-        pass
+    """ Fetch companies.xml, relief-statements.xml, ib-affiliates.xml and exchange rates """
+    fetchReferenceData()
 
-    for cs in companiesXmls:
-        for company in cs:
-            c = {
-                "isin": "",
-                "symbol": company.find("symbol").text.strip(),
-                "name": company.find("name").text.strip(),
-                "taxNumber": "",
-                "address": company.find("address").text.strip(),
-                "country": company.find("country").text.strip(),
-                "conid": None,
-            }
-            if company.find("isin") is not None and company.find("isin").text is not None:
-                c["isin"] = company.find("isin").text.strip()
-            if company.find("taxNumber") is not None and company.find("taxNumber").text is not None:
-                c["taxNumber"] = company.find("taxNumber").text.strip()
-            if company.find("conid") is not None and company.find("conid").text is not None:
-                c["conid"] = company.find("conid").text.strip()
-            if c["isin"] != "":
-                for x in companies:
-                    if x["isin"] != "" and x["isin"] == c["isin"]:
-                        break
-                    elif x["isin"] == "" and c["conid"] is not None and x["conid"] == c["conid"]:
-                        x["isin"] = c["isin"]
-                        break
-                    elif x["isin"] == "" and c["symbol"] is not None and x["symbol"] == c["symbol"] and x["name"] == c["name"]:
-                        x["isin"] = c["isin"]
-                        break
-                else:
-                    companies.append(c)
-                continue
-            if c["conid"] is not None:
-                for x in companies:
-                    if x["conid"] is not None and x["conid"] == c["conid"]:
-                        break
-                    elif x["conid"] is None and c["symbol"] is not None and x["symbol"] == c["symbol"] and x["name"] == c["name"]:
-                        x["conid"] = c["conid"]
-                        break
-                else:
-                    companies.append(c)
-                continue
-            for x in companies:
-                if x["symbol"] == c["symbol"]:
-                    break
-            else:
-                companies.append(c)
-    if len(companies) > 0:
-        companies.sort(key=lambda x: x["symbol"])
-        cs = xml.etree.ElementTree.Element("companies")
-        for company in companies:
-            c = xml.etree.ElementTree.SubElement(cs, "company")
-            xml.etree.ElementTree.SubElement(c, "isin").text = company["isin"]
-            if company["conid"] is not None and company["conid"] != "":
-                xml.etree.ElementTree.SubElement(c, "conid").text = company["conid"]
-            xml.etree.ElementTree.SubElement(c, "symbol").text = company["symbol"]
-            xml.etree.ElementTree.SubElement(c, "name").text = company["name"]
-            xml.etree.ElementTree.SubElement(c, "taxNumber").text = company["taxNumber"]
-            xml.etree.ElementTree.SubElement(c, "address").text = company["address"]
-            xml.etree.ElementTree.SubElement(c, "country").text = company["country"]
-        tree = xml.etree.ElementTree.ElementTree(cs)
-        xml.etree.ElementTree.indent(tree)
-        tree.write("companies.xml")
-
-    """ Fetch relief-statements.xml from GitHub if it doesn't exist or hasn't been updated for a month and use the data for Doh-Div.xml """
-    if not os.path.isfile("relief-statements.xml")  or datetime.datetime.fromtimestamp(os.path.getctime("relief-statements.xml")) < (datetime.datetime.now() - datetime.timedelta(days=30)):
-        r = requests.get(
-            "https://github.com/jamsix/ib-edavki/raw/master/relief-statements.xml",
-            headers={"User-Agent": userAgent}
-        )
-        open("relief-statements.xml", 'wb').write(r.content)
-    if os.path.isfile("relief-statements.xml"):
-        statements = xml.etree.ElementTree.parse("relief-statements.xml").getroot()
-        for statement in statements:
-            for company in companies:
-                if company["country"] == statement.find("country").text:
-                    company["reliefStatement"] = statement.find(
-                        "statement"
-                    ).text
+    """ Merge data from local companies-local.xml and repo companies.xml into local companies.xml """
+    companies = loadCompanies()
 
     """ Creating daily exchange rates object """
-    bsRateXmlFilename = (
-        "bsrate-"
-        + str(datetime.date.today().year)
-        + str(datetime.date.today().month)
-        + str(datetime.date.today().day)
-        + ".xml"
-    )
-    if not os.path.isfile(bsRateXmlFilename):
-        for file in glob.glob("bsrate-*.xml"):
-            os.remove(file)
-        r = requests.get(bsRateXmlUrl, headers={"User-Agent": userAgent})
-        open(bsRateXmlFilename, 'wb').write(r.content)
-    bsRateXml = xml.etree.ElementTree.parse(bsRateXmlFilename).getroot()
-
-    rates = {}
-    for d in bsRateXml:
-        date = d.attrib["datum"].replace("-", "")
-        rates[date] = {}
-        for r in d:
-            currency = r.attrib["oznaka"]
-            rates[date][currency] = r.text
+    rateTable = RateTable(bsRateDbFilename)
 
     """ Parsing IB XMLs """
     ibTradesList = []
     ibCashTransactionsList = []
-    ibSecuritiesInfoList = []
     ibEntities = []
-    for ibXmlFilename in ibXmlFilenames:
-        ibXml = xml.etree.ElementTree.parse(ibXmlFilename).getroot()
-        ibFlexStatements = ibXml[0]
+    useCache = not args.no_cache
+    if args.jobs > 1 and len(ibXmlFilenames) > 1:
+        """ Each file is parsed in its own process, results are merged in the order of
+            the files on the command line, so the output is the same as in a serial run """
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(args.jobs, len(ibXmlFilenames))
+        ) as executor:
+            ibXmls = list(
+                executor.map(loadIbXml, ibXmlFilenames, itertools.repeat(useCache))
+            )
+    else:
+        ibXmls = map(loadIbXml, ibXmlFilenames, itertools.repeat(useCache))
+    ibXmls = zip(ibXmlFilenames, ibXmls)
+    if args.ledger is not None:
+        """ Reports are generated from all the transactions in the ledger, including the ones imported by previous runs """
+        ibXmls = [(args.ledger, loadLedger(args.ledger, ibXmls))]
+    for ibXmlFilename, ibFlexStatements in ibXmls:
         for ibFlexStatement in ibFlexStatements:
-            ibTradesList.append(ibFlexStatement.find("Trades"))
-            ibCashTransactionsList.append(ibFlexStatement.find("CashTransactions"))
-            ibSecuritiesInfoList.append(ibFlexStatement.find("SecuritiesInfo"))
+            ibTradesList.append(ibFlexStatement["trades"])
+            ibCashTransactionsList.append(ibFlexStatement["cashTransactions"])
 
-            if ibFlexStatement.find("AccountInformation") is not None:
+            accountInformation = ibFlexStatement["accountInformation"]
+            if accountInformation is not None:
                 for entity in ibEntities:
-                    if entity["accountId"] == ibFlexStatement.find(
-                        "AccountInformation"
-                    ).get("accountId"):
+                    if entity["accountId"] == accountInformation["accountId"]:
                         break
                 else:
-                    ibEntity = {
-                        "accountId": ibFlexStatement.find("AccountInformation").get(
-                            "accountId"
-                        ),
-                        "ibEntity": ibFlexStatement.find("AccountInformation").get(
-                            "ibEntity"
-                        ),
-                    }
-                    ibEntities.append(ibEntity)
+                    ibEntities.append(accountInformation)
             else:
                 print(
                     "Account Information section of flex report is missing for account "
-                    + ibFlexStatement.get("accountId")
+                    + ibFlexStatement["accountId"]
                     + " in file "
                     + ibXmlFilename
                 )
 
-            corporateActions = ibFlexStatement.find("CorporateActions")
-            if corporateActions is not None:
-                addStockSplits(corporateActions)
-                updateChangedCusipIsin(corporateActions)
-
-    if test == True:
-        statementStartDate = str(reportYear + testYearDiff) + "0101"
-        statementEndDate = str(reportYear + testYearDiff) + "1231"
-    else:
-        statementStartDate = str(reportYear) + "0101"
-        statementEndDate = str(reportYear) + "1231"
+            addStockSplits(ibFlexStatement["corporateActions"])
+            updateChangedCusipIsin(ibFlexStatement["corporateActions"])
+
+    """ Splits and CUSIP/ISIN changes already applied to the open lots from the snapshot are added, so they are
+        not applied again if they are reported again, CUSIP/ISIN changes from IB XMLs take precedence """
+    unmatchedQuantities = {}
+    if args.snapshot is not None:
+        (
+            snapshotTrades,
+            snapshotSplits,
+            snapshotCusipIsinChanges,
+            unmatchedQuantities,
+            snapshotSecurityGroups,
+        ) = loadOpenLotSnapshot(args.snapshot)
+        for key in snapshotSplits:
+            stockSplits[key].update(snapshotSplits[key])
+            splitTimelines.pop(key, None)
+        for cusipIsinOld in snapshotCusipIsinChanges:
+            cusipIsinChanges.setdefault(cusipIsinOld, snapshotCusipIsinChanges[cusipIsinOld])
+    resolveCusipIsinChanges()
 
     """
         IB is PITA in terms of unique security ID, old outputs and some asset types only have conid,
@@ -385,224 +1648,146 @@ def main():
     # cache for quick search of trades by transactionID
     tradesByTransactionID = {}
 
-    """ Get trades from IB XML and sort them by securityID """
+    """ Apply stock splits and CUSIP/ISIN changes to trades from IB XML and sort them by securityID """
     for ibTrades in ibTradesList:
-        if ibTrades is None:
-            continue
-        for ibTrade in ibTrades:
-            if ibTrade.attrib["assetCategory"] in ignoreAssets:
-                continue
-
-            """ dateTime is now the primary parameter, but old reports only have tradeDate and sometimes tradeTime """
-            try:
-                dateTime = ibTrade.attrib["dateTime"].split(";")
-                date = dateTime[0]
-                time = dateTime[1]
-            except:
-                date = ibTrade.attrib["tradeDate"]
-                try:
-                    time = ibTrade.attrib["tradeTime"]
-                except KeyError:
-                    time = "000000"
-
-            # Trade tag
-            if ibTrade.tag == "Trade":
-                trade = {
-                    "conid": ibTrade.attrib["conid"],
-                    "symbol": ibTrade.attrib["symbol"],
-                    "currency": ibTrade.attrib["currency"],
-                    "assetCategory": ibTrade.attrib["assetCategory"],
-                    "tradePrice": float(ibTrade.attrib["tradePrice"]),
-                    "quantity": float(ibTrade.attrib["quantity"]),
-                    "buySell": ibTrade.attrib["buySell"],
-                    "tradeDate": date,
-                    "tradeTime": time,
-                    "transactionID": ibTrade.attrib["transactionID"],
-                    "ibOrderID": ibTrade.attrib["ibOrderID"],
-                    "openCloseIndicator": ibTrade.attrib["openCloseIndicator"],
-                }
-                if len(ibTrade.attrib["isin"]) > 0:
-                    trade["isin"] = getLatestCusipIsin(ibTrade.attrib["isin"])
-                if len(ibTrade.attrib["cusip"]) > 0:
-                    trade["cusip"] = getLatestCusipIsin(ibTrade.attrib["cusip"])
-                if len(ibTrade.attrib["securityID"]) > 0:
-                    trade["securityID"] = ibTrade.attrib["securityID"]
-
-                splitMultiplier = getSplitMultiplier(
-                    trade["symbol"], trade["conid"], date, time
-                )
-
-                trade["quantity"] *= splitMultiplier
-                trade["tradePrice"] /= splitMultiplier
-
-                if ibTrade.attrib["securityID"] != "":
-                    trade["securityID"] = ibTrade.attrib["securityID"]
-                if ibTrade.attrib["isin"] != "":
-                    trade["isin"] = getLatestCusipIsin(ibTrade.attrib["isin"])
-                if ibTrade.attrib["cusip"] != "":
-                    trade["cusip"] = getLatestCusipIsin(ibTrade.attrib["cusip"])
-                if ibTrade.attrib["description"] != "":
-                    trade["description"] = ibTrade.attrib["description"]
-                """ Futures and options have multipliers, i.e. a quantity of 1 with tradePrice 3 and multiplier 100 is actually a future/option for 100 stocks, worth 100 x 3 = 300 """
-                if "multiplier" in ibTrade.attrib:
-                    trade["tradePrice"] = trade["tradePrice"] * float(
-                        ibTrade.attrib["multiplier"]
-                    )
+        for trade in ibTrades:
+            if trade.isin is not None:
+                trade.isin = getLatestCusipIsin(trade.isin)
+            if trade.cusip is not None:
+                trade.cusip = getLatestCusipIsin(trade.cusip)
+
+            splitMultiplier = getSplitMultiplier(
+                trade.symbol, trade.conid, trade.tradeDate, trade.tradeTime
+            )
 
-                lastTrade = trade
-
-                if "isin" in trade:
-                    if trade["isin"] not in tradesByIsin:
-                        tradesByIsin[trade["isin"]] = []
-                    tradesByIsin[trade["isin"]].append(trade)
-                elif "cusip" in trade:
-                    if trade["cusip"] not in tradesByCusip:
-                        tradesByCusip[trade["cusip"]] = []
-                    tradesByCusip[trade["cusip"]].append(trade)
-                elif "securityID" in trade:
-                    if trade["securityID"] not in tradesBySecurityId:
-                        tradesBySecurityId[trade["securityID"]] = []
-                    tradesBySecurityId[trade["securityID"]].append(trade)
-                elif "conid" in trade:
-                    if trade["conid"] not in tradesByConid:
-                        tradesByConid[trade["conid"]] = []
-                    tradesByConid[trade["conid"]].append(trade)
-                elif "symbol" in trade:
-                    if trade["symbol"] not in tradesBySymbol:
-                        tradesBySymbol[trade["symbol"]] = []
-                    tradesBySymbol[trade["symbol"]].append(trade)
-                # Cache trades by transactionID
-                if trade["transactionID"] not in tradesByTransactionID:
-                    tradesByTransactionID[trade["transactionID"]] = trade
-
-            # Lot tag (corresponding sell transaction reference)
-            elif ibTrade.tag == "Lot" and lastTrade != None:
-                if "openTransactionIds" not in lastTrade:
-                    lastTrade["openTransactionIds"] = {}
-                tid = ibTrade.attrib["transactionID"]
+            trade.quantity *= splitMultiplier
+            trade.tradePrice /= splitMultiplier
+
+            """ Futures and options have multipliers, i.e. a quantity of 1 with tradePrice 3 and multiplier 100 is actually a future/option for 100 stocks, worth 100 x 3 = 300 """
+            if trade.multiplier is not None:
+                trade.tradePrice = trade.tradePrice * trade.multiplier
+
+            if trade.isin is not None:
+                if trade.isin not in tradesByIsin:
+                    tradesByIsin[trade.isin] = []
+                tradesByIsin[trade.isin].append(trade)
+            elif trade.cusip is not None:
+                if trade.cusip not in tradesByCusip:
+                    tradesByCusip[trade.cusip] = []
+                tradesByCusip[trade.cusip].append(trade)
+            elif trade.securityID is not None:
+                if trade.securityID not in tradesBySecurityId:
+                    tradesBySecurityId[trade.securityID] = []
+                tradesBySecurityId[trade.securityID].append(trade)
+            elif trade.conid is not None:
+                if trade.conid not in tradesByConid:
+                    tradesByConid[trade.conid] = []
+                tradesByConid[trade.conid].append(trade)
+            elif trade.symbol is not None:
+                if trade.symbol not in tradesBySymbol:
+                    tradesBySymbol[trade.symbol] = []
+                tradesBySymbol[trade.symbol].append(trade)
+            # Cache trades by transactionID
+            if trade.transactionID not in tradesByTransactionID:
+                tradesByTransactionID[trade.transactionID] = trade
+
+            # Lots (corresponding open transaction references of a closing trade)
+            for lot in trade.lots:
+                if trade.openTransactionIds is None:
+                    trade.openTransactionIds = {}
+                tid = lot.transactionID
 
                 splitMultiplier = getSplitMultiplier(
-                    ibTrade.attrib["symbol"], ibTrade.attrib["conid"], date, time
+                    lot.symbol, lot.conid, lot.date, lot.time
                 )
 
-                if tid not in lastTrade["openTransactionIds"]:
-                    lastTrade["openTransactionIds"][tid] = {
-                        "openDateTime": ibTrade.attrib["openDateTime"],
-                        "quantity": (
-                        float(ibTrade.attrib["quantity"]) * splitMultiplier
-                        ),
-                    }
+                if tid not in trade.openTransactionIds:
+                    lot.quantity *= splitMultiplier
+                    trade.openTransactionIds[tid] = lot
                 else:
-                    lastTrade["openTransactionIds"][tid]["quantity"] += (
-                        float(ibTrade.attrib["quantity"]) * splitMultiplier
+                    trade.openTransactionIds[tid].quantity += (
+                        lot.quantity * splitMultiplier
                     )
+            trade.lots = None
+
+    """ Open lots from the snapshot are only referenced by closing trades, trades from IB XMLs take precedence """
+    if args.snapshot is not None:
+        for trade in snapshotTrades:
+            if trade.transactionID in tradesByTransactionID:
+                continue
+            applySnapshotChanges(trade, snapshotSplits.get(trade.conid, ()))
+            tradesByTransactionID[trade.transactionID] = trade
 
     """
         Merge tradesByIsin, tradesByCusip, tradesBySecurityId, tradesByConid  and tradesBySymbol
         into a single trades Dict with keys in the following order of precedence:
         ISIN > CUSIP > securityID > CONID > Symbol
     """
-    trades = tradesByIsin
-    for cusip in tradesByCusip:
-        match = False
-        for id in trades:
-            for trade in trades[id]:
-                if "cusip" in trade and cusip == trade["cusip"]:
-                    trades[id] += tradesByCusip[cusip]
-                    match = True
-                    break
-            if match == True:
-                break
-        if match == False:
-            trades[cusip] = tradesByCusip[cusip]
-    for securityID in tradesBySecurityId:
-        match = False
-        for id in trades:
-            for trade in trades[id]:
-                if "securityID" in trade and securityID == trade["securityID"]:
-                    trades[id] += tradesBySecurityId[securityID]
-                    match = True
-                    break
-            if match == True:
-                break
-        if match == False:
-            trades[securityID] = tradesBySecurityId[securityID]
-    for conid in tradesByConid:
-        match = False
-        for id in trades:
-            for trade in trades[id]:
-                if "conid" in trade and conid == trade["conid"]:
-                    trades[id] += tradesByConid[conid]
-                    match = True
-                    break
-            if match == True:
-                break
-        if match == False:
-            trades[conid] = tradesByConid[conid]
-    for symbol in tradesBySymbol:
-        match = False
-        for id in trades:
-            for trade in trades[id]:
-                if "symbol" in trade and symbol == trade["symbol"]:
-                    trades[id] += tradesBySymbol[symbol]
-                    match = True
-                    break
-            if match == True:
-                break
-        if match == False:
-            trades[symbol] = tradesBySymbol[symbol]
+    securityIdentities = SecurityIdentityResolver()
+    if args.snapshot is not None:
+        securityIdentities.restoreState(snapshotSecurityGroups)
+    for field, tradesById in [
+        ("isin", tradesByIsin),
+        ("cusip", tradesByCusip),
+        ("securityID", tradesBySecurityId),
+        ("conid", tradesByConid),
+        ("symbol", tradesBySymbol),
+    ]:
+        for id in tradesById:
+            securityIdentities.add(field, id, tradesById[id])
+    trades = securityIdentities.getTrades()
 
     """ If a trade is both closing and opening, i.e. it goes from negative into positive
         balance or vice versa, split it into one closing and one opening trade """
     for securityID in trades:
         xtrades = []
         for trade in trades[securityID]:
-            if trade["openCloseIndicator"] != "C;O":
+            if trade.openCloseIndicator != "C;O":
                 xtrades.append(trade)
             else:
                 openSum = 0
-                for openTransactionId in trade["openTransactionIds"]:
-                    openSum += trade["openTransactionIds"][openTransactionId]["quantity"]
-                if abs(trade["quantity"]) == abs(openSum):
+                for openTransactionId in trade.openTransactionIds:
+                    openSum += trade.openTransactionIds[openTransactionId].quantity
+                if abs(trade.quantity) == abs(openSum):
                     xtrades.append(trade)
                 else:
                     closeTrade = trade.copy()
                     openTrade = trade.copy()
-                    closeTrade["openCloseIndicator"] = "C"
-                    openTrade["openCloseIndicator"] = "O"
-                    closeTrade["quantity"] = -openSum
-                    openTrade["quantity"] = trade["quantity"] - closeTrade["quantity"]
-                    del openTrade["openTransactionIds"]
+                    closeTrade.openCloseIndicator = "C"
+                    openTrade.openCloseIndicator = "O"
+                    closeTrade.quantity = -openSum
+                    openTrade.quantity = trade.quantity - closeTrade.quantity
+                    openTrade.openTransactionIds = None
                     xtrades.append(closeTrade)
                     xtrades.append(openTrade)
         trades[securityID] = xtrades
 
-    """ Detect if trades are Normal or Derivates and if they are Opening or Closing positions
-        Convert the price to EUR """
+    """ Convert the price to EUR """
+    allTrades = [trade for securityID in trades for trade in trades[securityID]]
+    pricesEUR = rateTable.convertToEUR(
+        (trade.tradeDate, trade.currency, trade.tradePrice) for trade in allTrades
+    )
+    for trade, priceEUR in zip(allTrades, pricesEUR):
+        trade.tradePriceEUR = priceEUR
+
+    """ Detect if trades are Normal or Derivates and if they are Opening or Closing positions """
     removed_security_ids = defaultdict(lambda: set())
     for securityID in trades:
         for trade in trades[securityID]:
-            if trade["currency"] == "EUR":
-                trade["tradePriceEUR"] = trade["tradePrice"]
-            else:
-                trade["tradePriceEUR"] = trade["tradePrice"] / getCurrencyRate(
-                    trade["tradeDate"], trade["currency"], rates
-                )
-
-            if (trade["openCloseIndicator"] == "O" and trade["quantity"] > 0) or (
-                trade["openCloseIndicator"] == "C" and trade["quantity"] < 0
+            if (trade.openCloseIndicator == "O" and trade.quantity > 0) or (
+                trade.openCloseIndicator == "C" and trade.quantity < 0
             ):
-                trade["positionType"] = "long"
+                trade.positionType = "long"
             else:
-                trade["positionType"] = "short"
+                trade.positionType = "short"
 
-            if trade["assetCategory"] in normalAssets:
-                trade["assetType"] = "normal"
-            elif trade["assetCategory"] in derivateAssets:
-                trade["assetType"] = "derivate"
+            if trade.assetCategory in normalAssets:
+                trade.assetType = "normal"
+            elif trade.assetCategory in derivateAssets:
+                trade.assetType = "derivate"
             else:
-                removed_security_ids[securityID].add(trade["assetCategory"])
-                # sys.exit("Error: unknown asset type: %s" % trade["assetCategory"])
+                removed_security_ids[securityID].add(trade.assetCategory)
+                # sys.exit("Error: unknown asset type: %s" % trade.assetCategory)
     if removed_security_ids:
         print(
             "WARNING: We are skipping the following securities because their assetCategories are currently not supported\n"
@@ -615,23 +1800,28 @@ def main():
                 print(" %s" % assetCategory, end=", ")
             print()
 
-    """ Filter trades to only include those that closed in the parameter year and trades that opened the closing position """
-    yearTrades = {}
+    """ Filter trades to only include those that closed in the report years and trades that opened the closing position,
+        partitioned by the year of closing """
+    yearTradesByYear = {str(reportYear): {} for reportYear in reportYears}
     for securityID in trades:
         for trade in trades[securityID]:
             if (
-                trade["tradeDate"][0:4] == str(reportYear)
-                and trade["openCloseIndicator"] == "C"
+                trade.tradeDate[0:4] in yearTradesByYear
+                and trade.openCloseIndicator == "C"
             ):
+                yearTrades = yearTradesByYear[trade.tradeDate[0:4]]
                 if securityID not in yearTrades:
                     yearTrades[securityID] = []
                 """ Look for the past open trades by TransactionID from Lot """
-                for tid in trade["openTransactionIds"]:
+                for tid in trade.openTransactionIds:
                     # Check if open transactionID record is missing and print missing info
                     if tid not in tradesByTransactionID:
+                        if tid in unmatchedQuantities:
+                            """ Closing and opening trade from the snapshot, not matched as in a run over the full history """
+                            continue
                         # Get date from transactionID's openDateTime
                         try:
-                            strOpenDateTime = trade["openTransactionIds"][tid]["openDateTime"].split(";")
+                            strOpenDateTime = trade.openTransactionIds[tid].openDateTime.split(";")
                             strOpenDate = strOpenDateTime[0]
                             strOpenTime = strOpenDateTime[1]
                         except:
@@ -646,39 +1836,92 @@ def main():
                     else:
                         """ Get the corresponding open trade (which may have different initial securityID) """
                         xtrade = tradesByTransactionID[tid]
-                        if (xtrade["openCloseIndicator"] == "O"):
-                            ctrade = copy.copy(xtrade)
-                            ctrade["quantity"] = trade["openTransactionIds"][tid]["quantity"]
+                        if (xtrade.openCloseIndicator == "O"):
+                            ctrade = xtrade.copy()
+                            ctrade.quantity = trade.openTransactionIds[tid].quantity
                             yearTrades[securityID].append(ctrade)
 
                 yearTrades[securityID].append(trade)
 
-    """ Logical trade order can be executed as multiple suborders at different price. Merge suborders in a single logical order. """
+    """ Classify cash transactions of the report years, grouped by flex statement as before """
+    cashTransactionsByYear = classifyCashTransactions(ibCashTransactionsList, reportYears)
+
+    if args.export_snapshot is not None:
+        exportOpenLotSnapshot(
+            args.export_snapshot,
+            max(reportYears),
+            tradesByTransactionID,
+            unmatchedQuantities,
+            securityIdentities,
+        )
+
+    descriptionMatcher = DescriptionMatcher()
+    reliefStatements = ReliefStatements()
+    for reportYear in reportYears:
+        generateReports(
+            reportYear,
+            test,
+            yearTradesByYear[str(reportYear)],
+            cashTransactionsByYear[str(reportYear)],
+            taxpayerConfig,
+            companies,
+            reliefStatements,
+            securityIdentities,
+            rateTable,
+            descriptionMatcher,
+            ibEntities,
+            len(reportYears) > 1,
+        )
+
+
+""" Generates Doh-KDVP.xml, D-IFI.xml, Doh-Div.xml and Doh-Obr.xml for a report year from trades that
+    closed in the year (and their opening trades) and cash transactions of the year. When reports
+    for multiple years are generated, the year is appended to filenames.
+"""
+def generateReports(
+    reportYear,
+    test,
+    yearTrades,
+    cashTransactions,
+    taxpayerConfig,
+    companies,
+    reliefStatements,
+    securityIdentities,
+    rateTable,
+    descriptionMatcher,
+    ibEntities,
+    multipleYears,
+):
+    if test == True:
+        testYearDiff = reportYear - datetime.date.today().year - 1
+        statementStartDate = str(reportYear + testYearDiff) + "0101"
+        statementEndDate = str(reportYear + testYearDiff) + "1231"
+    else:
+        testYearDiff = 0
+        statementStartDate = str(reportYear) + "0101"
+        statementEndDate = str(reportYear) + "1231"
+
+    """ Logical trade order can be executed as multiple suborders at different price. Merge suborders in a single logical order.
+        Suborders are merged into the first suborder of the same order, found by (securityID, ibOrderID, openCloseIndicator).
+        The weighted average price is updated with every suborder in the same way as before, so the results are identical. """
     mergedTrades = {}
+    mergedOrders = {}
     for securityID in yearTrades:
         for trade in yearTrades[securityID]:
-            tradeExists = False
-            if securityID in mergedTrades:
-                for previousTrade in mergedTrades[securityID]:
-                    if (
-                        previousTrade["ibOrderID"] == trade["ibOrderID"]
-                        and previousTrade["openCloseIndicator"]
-                        == trade["openCloseIndicator"]
-                    ):
-                        previousTrade["tradePrice"] = (
-                            previousTrade["quantity"] * previousTrade["tradePrice"]
-                            + trade["quantity"] * trade["tradePrice"]
-                        ) / (previousTrade["quantity"] + trade["quantity"])
-                        previousTrade["tradePriceEUR"] = (
-                            previousTrade["quantity"] * previousTrade["tradePriceEUR"]
-                            + trade["quantity"] * trade["tradePriceEUR"]
-                        ) / (previousTrade["quantity"] + trade["quantity"])
-                        previousTrade["quantity"] = (
-                            previousTrade["quantity"] + trade["quantity"]
-                        )
-                        tradeExists = True
-                        break
-            if tradeExists == False:
+            orderKey = (securityID, trade.ibOrderID, trade.openCloseIndicator)
+            if orderKey in mergedOrders:
+                previousTrade = mergedOrders[orderKey]
+                previousTrade.tradePrice = (
+                    previousTrade.quantity * previousTrade.tradePrice
+                    + trade.quantity * trade.tradePrice
+                ) / (previousTrade.quantity + trade.quantity)
+                previousTrade.tradePriceEUR = (
+                    previousTrade.quantity * previousTrade.tradePriceEUR
+                    + trade.quantity * trade.tradePriceEUR
+                ) / (previousTrade.quantity + trade.quantity)
+                previousTrade.quantity = previousTrade.quantity + trade.quantity
+            else:
+                mergedOrders[orderKey] = trade
                 if securityID not in mergedTrades:
                     mergedTrades[securityID] = []
                 mergedTrades[securityID].append(trade)
@@ -687,7 +1930,7 @@ def main():
     for securityID in mergedTrades:
         l = sorted(
             mergedTrades[securityID],
-            key=lambda k: "%s%s" % (k["tradeDate"], k["tradeTime"]),
+            key=lambda k: "%s%s" % (k.tradeDate, k.tradeTime),
         )
         mergedTrades[securityID] = l
 
@@ -699,19 +1942,19 @@ def main():
 
     for securityID in mergedTrades:
         for trade in mergedTrades[securityID]:
-            if trade["assetType"] == "normal" and trade["positionType"] == "long":
+            if trade.assetType == "normal" and trade.positionType == "long":
                 if securityID not in longNormalTrades:
                     longNormalTrades[securityID] = []
                 longNormalTrades[securityID].append(trade)
-            elif trade["assetType"] == "normal" and trade["positionType"] == "short":
+            elif trade.assetType == "normal" and trade.positionType == "short":
                 if securityID not in shortNormalTrades:
                     shortNormalTrades[securityID] = []
                 shortNormalTrades[securityID].append(trade)
-            elif trade["assetType"] == "derivate" and trade["positionType"] == "long":
+            elif trade.assetType == "derivate" and trade.positionType == "long":
                 if securityID not in longDerivateTrades:
                     longDerivateTrades[securityID] = []
                 longDerivateTrades[securityID].append(trade)
-            elif trade["assetType"] == "derivate" and trade["positionType"] == "short":
+            elif trade.assetType == "derivate" and trade.positionType == "short":
                 if securityID not in shortDerivateTrades:
                     shortDerivateTrades[securityID] = []
                 shortDerivateTrades[securityID].append(trade)
@@ -793,9 +2036,7 @@ def main():
         InventoryListType = xml.etree.ElementTree.SubElement(
             KDVPItem, "InventoryListType"
         ).text = "PLVP"
-        Name = xml.etree.ElementTree.SubElement(KDVPItem, "Name").text = trades[0][
-            "description"
-        ]
+        Name = xml.etree.ElementTree.SubElement(KDVPItem, "Name").text = trades[0].description
         HasForeignTax = xml.etree.ElementTree.SubElement(
             KDVPItem, "HasForeignTax"
         ).text = "false"
@@ -809,17 +2050,11 @@ def main():
             KDVPItem, "TaxDecreaseConformance"
         ).text = "false"
         Securities = xml.etree.ElementTree.SubElement(KDVPItem, "Securities")
-        if len(trades) > 0 and "isin" in trades[0]:
-            ISIN = xml.etree.ElementTree.SubElement(Securities, "ISIN").text = trades[
-                0
-            ]["isin"]
-        Code = xml.etree.ElementTree.SubElement(Securities, "Code").text = trades[0][
-            "symbol"
-        ][:10]
-        if len(trades) > 0 and "description" in trades[0]:
-            Name = xml.etree.ElementTree.SubElement(Securities, "Name").text = trades[
-                0
-            ]["description"]
+        if len(trades) > 0 and trades[0].isin is not None:
+            ISIN = xml.etree.ElementTree.SubElement(Securities, "ISIN").text = trades[0].isin
+        Code = xml.etree.ElementTree.SubElement(Securities, "Code").text = trades[0].symbol[:10]
+        if len(trades) > 0 and trades[0].description is not None:
+            Name = xml.etree.ElementTree.SubElement(Securities, "Name").text = trades[0].description
         IsFond = xml.etree.ElementTree.SubElement(Securities, "IsFond").text = "false"
 
         F8Value = 0
@@ -827,28 +2062,28 @@ def main():
         for trade in trades:
             n += 1
             if test == True:
-                tradeYear = int(trade["tradeDate"][0:4]) + testYearDiff
+                tradeYear = int(trade.tradeDate[0:4]) + testYearDiff
             else:
-                tradeYear = int(trade["tradeDate"][0:4])
+                tradeYear = int(trade.tradeDate[0:4])
             tradeYearsInNormalReport.add(str(tradeYear))
             Row = xml.etree.ElementTree.SubElement(Securities, "Row")
             ID = xml.etree.ElementTree.SubElement(Row, "ID").text = str(n)
-            if trade["quantity"] > 0:
+            if trade.quantity > 0:
                 PurchaseSale = xml.etree.ElementTree.SubElement(Row, "Purchase")
                 F1 = xml.etree.ElementTree.SubElement(PurchaseSale, "F1").text = (
                     str(tradeYear)
                     + "-"
-                    + trade["tradeDate"][4:6]
+                    + trade.tradeDate[4:6]
                     + "-"
-                    + trade["tradeDate"][6:8]
+                    + trade.tradeDate[6:8]
                 )
                 F2 = xml.etree.ElementTree.SubElement(PurchaseSale, "F2").text = "B"
                 F3 = xml.etree.ElementTree.SubElement(
                     PurchaseSale, "F3"
-                ).text = "{0:.4f}".format(trade["quantity"])
+                ).text = "{0:.4f}".format(trade.quantity)
                 F4 = xml.etree.ElementTree.SubElement(
                     PurchaseSale, "F4"
-                ).text = "{0:.4f}".format(trade["tradePriceEUR"])
+                ).text = "{0:.4f}".format(trade.tradePriceEUR)
                 F5 = xml.etree.ElementTree.SubElement(
                     PurchaseSale, "F5"
                 ).text = "0.0000"
@@ -857,17 +2092,17 @@ def main():
                 F6 = xml.etree.ElementTree.SubElement(PurchaseSale, "F6").text = (
                     str(tradeYear)
                     + "-"
-                    + trade["tradeDate"][4:6]
+                    + trade.tradeDate[4:6]
                     + "-"
-                    + trade["tradeDate"][6:8]
+                    + trade.tradeDate[6:8]
                 )
                 F7 = xml.etree.ElementTree.SubElement(
                     PurchaseSale, "F7"
-                ).text = "{0:.4f}".format(-trade["quantity"])
+                ).text = "{0:.4f}".format(-trade.quantity)
                 F9 = xml.etree.ElementTree.SubElement(
                     PurchaseSale, "F9"
-                ).text = "{0:.4f}".format(trade["tradePriceEUR"])
-            F8Value += trade["quantity"]
+                ).text = "{0:.4f}".format(trade.tradePriceEUR)
+            F8Value += trade.quantity
             F8 = xml.etree.ElementTree.SubElement(Row, "F8").text = "{0:.4f}".format(
                 F8Value
             )
@@ -878,9 +2113,7 @@ def main():
         InventoryListType = xml.etree.ElementTree.SubElement(
             KDVPItem, "InventoryListType"
         ).text = "PLVPSHORT"
-        Name = xml.etree.ElementTree.SubElement(KDVPItem, "Name").text = trades[0][
-            "description"
-        ]
+        Name = xml.etree.ElementTree.SubElement(KDVPItem, "Name").text = trades[0].description
         HasForeignTax = xml.etree.ElementTree.SubElement(
             KDVPItem, "HasForeignTax"
         ).text = "false"
@@ -894,17 +2127,15 @@ def main():
             KDVPItem, "TaxDecreaseConformance"
         ).text = "false"
         SecuritiesShort = xml.etree.ElementTree.SubElement(KDVPItem, "SecuritiesShort")
-        if len(trades) > 0 and "isin" in trades[0]:
+        if len(trades) > 0 and trades[0].isin is not None:
             ISIN = xml.etree.ElementTree.SubElement(
                 SecuritiesShort, "ISIN"
-            ).text = trades[0]["isin"]
-        Code = xml.etree.ElementTree.SubElement(SecuritiesShort, "Code").text = trades[
-            0
-        ]["symbol"][:10]
-        if len(trades) > 0 and "description" in trades[0]:
+            ).text = trades[0].isin
+        Code = xml.etree.ElementTree.SubElement(SecuritiesShort, "Code").text = trades[0].symbol[:10]
+        if len(trades) > 0 and trades[0].description is not None:
             Name = xml.etree.ElementTree.SubElement(
                 SecuritiesShort, "Name"
-            ).text = trades[0]["description"]
+            ).text = trades[0].description
         IsFond = xml.etree.ElementTree.SubElement(
             SecuritiesShort, "IsFond"
         ).text = "false"
@@ -914,28 +2145,28 @@ def main():
         for trade in trades:
             n += 1
             if test == True:
-                tradeYear = int(trade["tradeDate"][0:4]) + testYearDiff
+                tradeYear = int(trade.tradeDate[0:4]) + testYearDiff
             else:
-                tradeYear = int(trade["tradeDate"][0:4])
+                tradeYear = int(trade.tradeDate[0:4])
             tradeYearsInNormalReport.add(str(tradeYear))
             Row = xml.etree.ElementTree.SubElement(SecuritiesShort, "Row")
             ID = xml.etree.ElementTree.SubElement(Row, "ID").text = str(n)
-            if trade["quantity"] > 0:
+            if trade.quantity > 0:
                 PurchaseSale = xml.etree.ElementTree.SubElement(Row, "Purchase")
                 F1 = xml.etree.ElementTree.SubElement(PurchaseSale, "F1").text = (
                     str(tradeYear)
                     + "-"
-                    + trade["tradeDate"][4:6]
+                    + trade.tradeDate[4:6]
                     + "-"
-                    + trade["tradeDate"][6:8]
+                    + trade.tradeDate[6:8]
                 )
                 F2 = xml.etree.ElementTree.SubElement(PurchaseSale, "F2").text = "A"
                 F3 = xml.etree.ElementTree.SubElement(
                     PurchaseSale, "F3"
-                ).text = "{0:.4f}".format(trade["quantity"])
+                ).text = "{0:.4f}".format(trade.quantity)
                 F4 = xml.etree.ElementTree.SubElement(
                     PurchaseSale, "F4"
-                ).text = "{0:.4f}".format(trade["tradePriceEUR"])
+                ).text = "{0:.4f}".format(trade.tradePriceEUR)
                 F5 = xml.etree.ElementTree.SubElement(
                     PurchaseSale, "F5"
                 ).text = "0.0000"
@@ -944,32 +2175,32 @@ def main():
                 F6 = xml.etree.ElementTree.SubElement(PurchaseSale, "F6").text = (
                     str(tradeYear)
                     + "-"
-                    + trade["tradeDate"][4:6]
+                    + trade.tradeDate[4:6]
                     + "-"
-                    + trade["tradeDate"][6:8]
+                    + trade.tradeDate[6:8]
                 )
                 F7 = xml.etree.ElementTree.SubElement(
                     PurchaseSale, "F7"
-                ).text = "{0:.4f}".format(-trade["quantity"])
+                ).text = "{0:.4f}".format(-trade.quantity)
                 F9 = xml.etree.ElementTree.SubElement(
                     PurchaseSale, "F9"
-                ).text = "{0:.4f}".format(trade["tradePriceEUR"])
-            F8Value += trade["quantity"]
+                ).text = "{0:.4f}".format(trade.tradePriceEUR)
+            F8Value += trade.quantity
             F8 = xml.etree.ElementTree.SubElement(Row, "F8").text = "{0:.4f}".format(
                 F8Value
             )
 
     xmlString = xml.etree.ElementTree.tostring(envelope)
     prettyXmlString = minidom.parseString(xmlString).toprettyxml(indent="\t")
-    with open("Doh-KDVP.xml", "w", encoding="utf-8") as f:
+    with open(getReportFilename("Doh-KDVP", reportYear, multipleYears), "w", encoding="utf-8") as f:
         f.write(prettyXmlString)
         if tradeYearsInNormalReport:
             print(
-                "Doh-KDVP.xml created (includes trades from years %s)"
-                % ", ".join(sorted(tradeYearsInNormalReport))
+                "%s created (includes trades from years %s)"
+                % (f.name, ", ".join(sorted(tradeYearsInNormalReport)))
             )
         else:
-            print("Doh-KDVP.xml created (includes no trades)")
+            print("%s created (includes no trades)" % f.name)
 
     """ Generate the files for Derivates """
     envelope = xml.etree.ElementTree.Element(
@@ -1033,17 +2264,17 @@ def main():
         n += 1
         TItem = xml.etree.ElementTree.SubElement(difi, "TItem")
         TypeId = xml.etree.ElementTree.SubElement(TItem, "TypeId").text = "PLIFI"
-        if trades[0]["assetCategory"] == "FUT":
+        if trades[0].assetCategory == "FUT":
             Type = xml.etree.ElementTree.SubElement(TItem, "Type").text = "01"
             TypeName = xml.etree.ElementTree.SubElement(
                 TItem, "TypeName"
             ).text = "terminska pogodba"
-        elif trades[0]["assetCategory"] in ["CFD", "FXCFD"]:
+        elif trades[0].assetCategory in ["CFD", "FXCFD"]:
             Type = xml.etree.ElementTree.SubElement(TItem, "Type").text = "02"
             TypeName = xml.etree.ElementTree.SubElement(
                 TItem, "TypeName"
             ).text = "finančne pogodbe na razliko"
-        elif trades[0]["assetCategory"] in ["OPT", "FOP"]:
+        elif trades[0].assetCategory in ["OPT", "FOP"]:
             Type = xml.etree.ElementTree.SubElement(TItem, "Type").text = "03"
             TypeName = xml.etree.ElementTree.SubElement(
                 TItem, "TypeName"
@@ -1053,19 +2284,13 @@ def main():
             TypeName = xml.etree.ElementTree.SubElement(
                 TItem, "TypeName"
             ).text = "drugo"
-        if len(trades) > 0 and "description" in trades[0]:
-            Name = xml.etree.ElementTree.SubElement(TItem, "Name").text = trades[0][
-                "description"
-            ]
-        if trades[0]["assetCategory"] != "OPT" and trades[0]["assetCategory"] != "WAR":
+        if len(trades) > 0 and trades[0].description is not None:
+            Name = xml.etree.ElementTree.SubElement(TItem, "Name").text = trades[0].description
+        if trades[0].assetCategory != "OPT" and trades[0].assetCategory != "WAR":
             """Option descriptions are to long and not accepted by eDavki"""
-            Code = xml.etree.ElementTree.SubElement(TItem, "Code").text = trades[0][
-                "symbol"
-            ][:10]
-        if len(trades) > 0 and "isin" in trades[0]:
-            ISIN = xml.etree.ElementTree.SubElement(TItem, "ISIN").text = trades[0][
-                "isin"
-            ]
+            Code = xml.etree.ElementTree.SubElement(TItem, "Code").text = trades[0].symbol[:10]
+        if len(trades) > 0 and trades[0].isin is not None:
+            ISIN = xml.etree.ElementTree.SubElement(TItem, "ISIN").text = trades[0].isin
         HasForeignTax = xml.etree.ElementTree.SubElement(
             TItem, "HasForeignTax"
         ).text = "false"
@@ -1073,27 +2298,27 @@ def main():
         F8Value = 0
         for trade in trades:
             if test == True:
-                tradeYear = int(trade["tradeDate"][0:4]) + testYearDiff
+                tradeYear = int(trade.tradeDate[0:4]) + testYearDiff
             else:
-                tradeYear = int(trade["tradeDate"][0:4])
+                tradeYear = int(trade.tradeDate[0:4])
             tradeYearsInDerivateReport.add(str(tradeYear))
             TSubItem = xml.etree.ElementTree.SubElement(TItem, "TSubItem")
-            if trade["quantity"] > 0:
+            if trade.quantity > 0:
                 PurchaseSale = xml.etree.ElementTree.SubElement(TSubItem, "Purchase")
                 F1 = xml.etree.ElementTree.SubElement(PurchaseSale, "F1").text = (
                     str(tradeYear)
                     + "-"
-                    + trade["tradeDate"][4:6]
+                    + trade.tradeDate[4:6]
                     + "-"
-                    + trade["tradeDate"][6:8]
+                    + trade.tradeDate[6:8]
                 )
                 F2 = xml.etree.ElementTree.SubElement(PurchaseSale, "F2").text = "A"
                 F3 = xml.etree.ElementTree.SubElement(
                     PurchaseSale, "F3"
-                ).text = "{0:.4f}".format(trade["quantity"])
+                ).text = "{0:.4f}".format(trade.quantity)
                 F4 = xml.etree.ElementTree.SubElement(
                     PurchaseSale, "F4"
-                ).text = "{0:.4f}".format(trade["tradePriceEUR"])
+                ).text = "{0:.4f}".format(trade.tradePriceEUR)
                 F9 = xml.etree.ElementTree.SubElement(PurchaseSale, "F9").text = "false"
                 # TODO: kako ugotovit iz reporta F9 = Trgovanje z vzvodom
             else:
@@ -1101,17 +2326,17 @@ def main():
                 F5 = xml.etree.ElementTree.SubElement(PurchaseSale, "F5").text = (
                     str(tradeYear)
                     + "-"
-                    + trade["tradeDate"][4:6]
+                    + trade.tradeDate[4:6]
                     + "-"
-                    + trade["tradeDate"][6:8]
+                    + trade.tradeDate[6:8]
                 )
                 F6 = xml.etree.ElementTree.SubElement(
                     PurchaseSale, "F6"
-                ).text = "{0:.4f}".format(-trade["quantity"])
+                ).text = "{0:.4f}".format(-trade.quantity)
                 F7 = xml.etree.ElementTree.SubElement(
                     PurchaseSale, "F7"
-                ).text = "{0:.4f}".format(trade["tradePriceEUR"])
-            F8Value += trade["quantity"]
+                ).text = "{0:.4f}".format(trade.tradePriceEUR)
+            F8Value += trade.quantity
             F8 = xml.etree.ElementTree.SubElement(
                 TSubItem, "F8"
             ).text = "{0:.4f}".format(F8Value)
@@ -1121,17 +2346,17 @@ def main():
         n += 1
         TItem = xml.etree.ElementTree.SubElement(difi, "TItem")
         TypeId = xml.etree.ElementTree.SubElement(TItem, "TypeId").text = "PLIFIShort"
-        if trades[0]["assetCategory"] == "FUT":
+        if trades[0].assetCategory == "FUT":
             Type = xml.etree.ElementTree.SubElement(TItem, "Type").text = "01"
             TypeName = xml.etree.ElementTree.SubElement(
                 TItem, "TypeName"
             ).text = "terminska pogodba"
-        elif trades[0]["assetCategory"] in ["CFD", "FXCFD"]:
+        elif trades[0].assetCategory in ["CFD", "FXCFD"]:
             Type = xml.etree.ElementTree.SubElement(TItem, "Type").text = "02"
             TypeName = xml.etree.ElementTree.SubElement(
                 TItem, "TypeName"
             ).text = "finančne pogodbe na razliko"
-        elif trades[0]["assetCategory"] == "OPT":
+        elif trades[0].assetCategory == "OPT":
             Type = xml.etree.ElementTree.SubElement(TItem, "Type").text = "03"
             TypeName = xml.etree.ElementTree.SubElement(
                 TItem, "TypeName"
@@ -1141,19 +2366,13 @@ def main():
             TypeName = xml.etree.ElementTree.SubElement(
                 TItem, "TypeName"
             ).text = "drugo"
-        if len(trades) > 0 and "description" in trades[0]:
-            Name = xml.etree.ElementTree.SubElement(TItem, "Name").text = trades[0][
-                "description"
-            ]
-        if trades[0]["assetCategory"] != "OPT" and trades[0]["assetCategory"] != "WAR":
+        if len(trades) > 0 and trades[0].description is not None:
+            Name = xml.etree.ElementTree.SubElement(TItem, "Name").text = trades[0].description
+        if trades[0].assetCategory != "OPT" and trades[0].assetCategory != "WAR":
             """Option descriptions are to long and not accepted by eDavki"""
-            Code = xml.etree.ElementTree.SubElement(TItem, "Code").text = trades[0][
-                "symbol"
-            ][:10]
-        if len(trades) > 0 and "isin" in trades[0]:
-            ISIN = xml.etree.ElementTree.SubElement(TItem, "ISIN").text = trades[0][
-                "isin"
-            ]
+            Code = xml.etree.ElementTree.SubElement(TItem, "Code").text = trades[0].symbol[:10]
+        if len(trades) > 0 and trades[0].isin is not None:
+            ISIN = xml.etree.ElementTree.SubElement(TItem, "ISIN").text = trades[0].isin
         HasForeignTax = xml.etree.ElementTree.SubElement(
             TItem, "HasForeignTax"
         ).text = "false"
@@ -1161,190 +2380,155 @@ def main():
         F8Value = 0
         for trade in trades:
             if test == True:
-                tradeYear = int(trade["tradeDate"][0:4]) + testYearDiff
+                tradeYear = int(trade.tradeDate[0:4]) + testYearDiff
             else:
-                tradeYear = int(trade["tradeDate"][0:4])
+                tradeYear = int(trade.tradeDate[0:4])
             tradeYearsInDerivateReport.add(str(tradeYear))
             TShortSubItem = xml.etree.ElementTree.SubElement(TItem, "TShortSubItem")
-            if trade["quantity"] > 0:
+            if trade.quantity > 0:
                 PurchaseSale = xml.etree.ElementTree.SubElement(
                     TShortSubItem, "Purchase"
                 )
                 F4 = xml.etree.ElementTree.SubElement(PurchaseSale, "F4").text = (
                     str(tradeYear)
                     + "-"
-                    + trade["tradeDate"][4:6]
+                    + trade.tradeDate[4:6]
                     + "-"
-                    + trade["tradeDate"][6:8]
+                    + trade.tradeDate[6:8]
                 )
                 F5 = xml.etree.ElementTree.SubElement(PurchaseSale, "F5").text = "A"
                 F6 = xml.etree.ElementTree.SubElement(
                     PurchaseSale, "F6"
-                ).text = "{0:.4f}".format(trade["quantity"])
+                ).text = "{0:.4f}".format(trade.quantity)
                 F7 = xml.etree.ElementTree.SubElement(
                     PurchaseSale, "F7"
-                ).text = "{0:.4f}".format(trade["tradePriceEUR"])
+                ).text = "{0:.4f}".format(trade.tradePriceEUR)
             else:
                 PurchaseSale = xml.etree.ElementTree.SubElement(TShortSubItem, "Sale")
                 F1 = xml.etree.ElementTree.SubElement(PurchaseSale, "F1").text = (
                     str(tradeYear)
                     + "-"
-                    + trade["tradeDate"][4:6]
+                    + trade.tradeDate[4:6]
                     + "-"
-                    + trade["tradeDate"][6:8]
+                    + trade.tradeDate[6:8]
                 )
                 F2 = xml.etree.ElementTree.SubElement(
                     PurchaseSale, "F2"
-                ).text = "{0:.4f}".format(-trade["quantity"])
+                ).text = "{0:.4f}".format(-trade.quantity)
                 F3 = xml.etree.ElementTree.SubElement(
                     PurchaseSale, "F3"
-                ).text = "{0:.4f}".format(trade["tradePriceEUR"])
+                ).text = "{0:.4f}".format(trade.tradePriceEUR)
                 F9 = xml.etree.ElementTree.SubElement(PurchaseSale, "F9").text = "false"
                 # TODO: kako ugotovit iz reporta F9 = Trgovanje z vzvodom
-            F8Value += trade["quantity"]
+            F8Value += trade.quantity
             F8 = xml.etree.ElementTree.SubElement(
                 TShortSubItem, "F8"
             ).text = "{0:.4f}".format(F8Value)
 
     xmlString = xml.etree.ElementTree.tostring(envelope)
     prettyXmlString = minidom.parseString(xmlString).toprettyxml(indent="\t")
-    with open("D-IFI.xml", "w", encoding="utf-8") as f:
+    with open(getReportFilename("D-IFI", reportYear, multipleYears), "w", encoding="utf-8") as f:
         f.write(prettyXmlString)
         if tradeYearsInDerivateReport:
             print(
-                "D-IFI.xml created (includes trades from years %s)"
-                % ", ".join(sorted(tradeYearsInDerivateReport))
+                "%s created (includes trades from years %s)"
+                % (f.name, ", ".join(sorted(tradeYearsInDerivateReport)))
             )
         else:
-            print("D-IFI.xml created (includes no trades)")
+            print("%s created (includes no trades)" % f.name)
 
     """ Get dividends from IB XML """
     dividends = []
+    """ Dividends by (payment date, symbol), each bucket sorted by (integer transactionID, position in dividends) """
+    dividendsByDateSymbol = defaultdict(list)
+    dividendTaxes = []
     missingCompanies = set()
 
-    for ibCashTransactions in ibCashTransactionsList:
-        if ibCashTransactions is None:
-            continue
-        for ibCashTransaction in ibCashTransactions:
-            """ Ignore levelOfDetail="SUMMARY" CashTransactions """
-            if ibCashTransaction.attrib["transactionID"] == "":
-                continue
-            if (
-                ibCashTransaction.tag == "CashTransaction"
-                and ibCashTransaction.attrib["dateTime"].startswith(str(reportYear))
-                and ibCashTransaction.attrib["type"]
-                in ["Dividends", "Payment In Lieu Of Dividends"]
-            ):
-                dividend = {
-                    "currency": ibCashTransaction.attrib["currency"],
-                    "type": ibCashTransaction.attrib["type"],
-                    "conid": ibCashTransaction.attrib["conid"],
-                    "amount": float(ibCashTransaction.attrib["amount"]),
-                    "symbol": ibCashTransaction.attrib["symbol"],
-                    "description": ibCashTransaction.attrib["description"],
-                    "dateTime": ibCashTransaction.attrib["dateTime"],
-                    "transactionID": ibCashTransaction.attrib["transactionID"],
-                    "tax": 0,
-                    "taxEUR": 0,
-                }
-                if ibCashTransaction.attrib.get("isin") is not None:
-                    dividend["isin"] = ibCashTransaction.attrib["isin"]
-                dividend["securityID"] = ibCashTransaction.attrib["securityID"]
-                if dividend["securityID"] == "":
-                    dividend["securityID"] = dividend["conid"]
-
-                company = None
-                for x in companies:
-                    if "isin" in x and x["isin"] != "" and "isin" in dividend and x["isin"] == dividend["isin"]:
-                        company = x
-                else:
-                    for x in companies:
-                        if "conid" in x and x["conid"] == dividend["conid"]:
-                            company = x
-                    else:
-                        for x in companies:
-                            if x["symbol"] == dividend["symbol"]:
-                                company = x
-
-                if company is not None:
-                    dividend["name"] = company["name"]
-                    dividend["taxNumber"] = company["taxNumber"]
-                    dividend["address"] = company["address"]
-                    dividend["country"] = company["country"]
-                    if "reliefStatement" in company:
-                        dividend["reliefStatement"] = company["reliefStatement"]
-                else:
-                    missingCompanies.add((dividend["conid"], dividend["symbol"]))
+    for statementCashTransactions in cashTransactions:
+        for date, ibCashTransaction in statementCashTransactions["dividends"]:
+            dividend = Dividend(
+                currency=sys.intern(ibCashTransaction["currency"]),
+                type=sys.intern(ibCashTransaction["type"]),
+                conid=sys.intern(ibCashTransaction["conid"]),
+                amount=float(ibCashTransaction["amount"]),
+                symbol=sys.intern(ibCashTransaction["symbol"]),
+                description=ibCashTransaction["description"],
+                dateTime=ibCashTransaction["dateTime"],
+                transactionID=ibCashTransaction["transactionID"],
+                tax=0,
+                taxEUR=0,
+                isin=ibCashTransaction.get("isin"),
+                securityID=ibCashTransaction["securityID"],
+            )
+            if dividend.securityID == "":
+                dividend.securityID = dividend.conid
+            """ Key dividends by the group of their security, so a dividend and its reversal
+                match even if IB books them under different identifiers of the same security """
+            securityKey = securityIdentities.resolve(
+                dividend.isin, dividend.securityID, dividend.conid, dividend.symbol
+            )
+            if securityKey is not None:
+                dividend.securityID = securityKey
+
+            company = companies.find(dividend.isin, dividend.conid, dividend.symbol)
+            if company is None and securityKey is not None:
+                """ The ISIN of the dividend may be older than the one the trades were merged into """
+                company = companies.find(securityKey, None, None)
+            if company is not None:
+                dividend.name = company["name"]
+                dividend.taxNumber = company["taxNumber"]
+                dividend.address = company["address"]
+                dividend.country = company["country"]
+                dividend.reliefStatement = reliefStatements.find(company["country"])
+            else:
+                missingCompanies.add((dividend.conid, dividend.symbol))
 
-                """ Convert amount to EUR """
-                if dividend["currency"] == "EUR":
-                    dividend["amountEUR"] = dividend["amount"]
-                else:
-                    dividend["amountEUR"] = dividend["amount"] / getCurrencyRate(
-                        dividend["dateTime"][0:8], dividend["currency"], rates
-                    )
-                dividends.append(dividend)
+            bisect.insort(
+                dividendsByDateSymbol[(date, dividend.symbol)],
+                (int(dividend.transactionID), len(dividends), dividend),
+            )
+            dividends.append(dividend)
 
         missing_dividends_for_witholding_tax = defaultdict(lambda: set())
-        for ibCashTransaction in ibCashTransactions:
-            """ Ignore levelOfDetail="SUMMARY" CashTransactions """
-            if ibCashTransaction.attrib["transactionID"] == "":
+        for date, ibCashTransaction in statementCashTransactions["dividendTaxes"]:
+            """ Dividends paid on the same day for the same symbol before the tax, in the order of dividends """
+            bucket = dividendsByDateSymbol.get((date, ibCashTransaction["symbol"]), [])
+            candidates = bucket[
+                : bisect.bisect_left(bucket, (int(ibCashTransaction["transactionID"]),))
+            ]
+            potentiallyMatchingDividends = [
+                dividend for _, _, dividend in sorted(candidates, key=lambda c: c[1])
+            ]
+
+            if len(potentiallyMatchingDividends) == 0:
+                missing_dividends_for_witholding_tax[
+                        ibCashTransaction["symbol"]].add(
+                                ibCashTransaction["transactionID"])
                 continue
-            if (
-                ibCashTransaction.tag == "CashTransaction"
-                and ibCashTransaction.attrib["dateTime"].startswith(str(reportYear))
-                and ibCashTransaction.attrib["type"] == "Withholding Tax"
-                and ibCashTransaction.attrib["conid"] != ""
-            ):
-                potentiallyMatchingDividends = []
-                for dividend in dividends:
-                    if (
-                        dividend["dateTime"][0:8]
-                        == ibCashTransaction.attrib["dateTime"][0:8]
-                        and dividend["symbol"] == ibCashTransaction.attrib["symbol"]
-                        and int(dividend["transactionID"])
-                        < int(ibCashTransaction.attrib["transactionID"])
-                    ):
-                        potentiallyMatchingDividends.append(dividend)
-
-                if len(potentiallyMatchingDividends) == 0:
-                    missing_dividends_for_witholding_tax[
-                            ibCashTransaction.attrib["symbol"]].add(
-                                    ibCashTransaction.attrib["transactionID"])
-                    continue
-                elif len(potentiallyMatchingDividends) == 1:
-                    closestDividend = potentiallyMatchingDividends[0]
-                else:
-                    """There are multiple dividends that potentially match the given
-                    tax. Unfortunately there is no reference that would point the
-                    tax entry to a dividend entry so we employ a simple string
-                    matching trick and find the dividend with a description that is
-                    the closest to the tax description.
-                    """
-                    closestDividend = potentiallyMatchingDividends[0]
-                    bestMatchLen = 0
-                    for dividend in potentiallyMatchingDividends:
-                        taxDescription = ibCashTransaction.attrib["description"]
-                        dividendDescription = dividend["description"]
-                        match = SequenceMatcher(
-                            None, taxDescription, dividendDescription
-                        ).find_longest_match(
-                            0, len(taxDescription), 0, len(dividendDescription)
-                        )
-                        if match.size > bestMatchLen:
-                            bestMatchLen = match.size
-                            closestDividend = dividend
-
-                closestDividendTax = -float(ibCashTransaction.attrib["amount"])
-                """ Convert amount to EUR """
-                if ibCashTransaction.attrib["currency"] == "EUR":
-                    closestDividend["taxEUR"] += closestDividendTax
-                else:
-                    closestDividend["taxEUR"] += closestDividendTax / getCurrencyRate(
-                        ibCashTransaction.attrib["dateTime"][0:8],
-                        ibCashTransaction.attrib["currency"],
-                        rates,
-                    )
+            elif len(potentiallyMatchingDividends) == 1:
+                closestDividend = potentiallyMatchingDividends[0]
+            else:
+                """There are multiple dividends that potentially match the given
+                tax. Unfortunately there is no reference that would point the
+                tax entry to a dividend entry so we employ a simple string
+                matching trick and find the dividend with a description that is
+                the closest to the tax description.
+                """
+                closestDividend = descriptionMatcher.findClosest(
+                    ibCashTransaction["description"],
+                    potentiallyMatchingDividends,
+                    lambda dividend: dividend.description,
+                )
+
+            closestDividendTax = -float(ibCashTransaction["amount"])
+            dividendTaxes.append(
+                (
+                    closestDividend,
+                    date,
+                    ibCashTransaction["currency"],
+                    closestDividendTax,
+                )
+            )
         if missing_dividends_for_witholding_tax:
             print(
                     "=============================================================================\n"
@@ -1364,6 +2548,19 @@ def main():
                 print()
             sys.exit("Aborting")
 
+    """ Convert dividends and withholding taxes to EUR """
+    amountsEUR = rateTable.convertToEUR(
+        (dividend.dateTime[0:8], dividend.currency, dividend.amount)
+        for dividend in dividends
+    )
+    for dividend, amountEUR in zip(dividends, amountsEUR):
+        dividend.amountEUR = amountEUR
+    taxesEUR = rateTable.convertToEUR(
+        (date, currency, tax) for dividend, date, currency, tax in dividendTaxes
+    )
+    for (dividend, date, currency, tax), taxEUR in zip(dividendTaxes, taxesEUR):
+        dividend.taxEUR += taxEUR
+
     if len(missingCompanies) > 0:
         explanation = "companies.xml is missing the following symbols (conids): "
         missing = map(lambda x: x[1] + " (" + x[0] + ")", missingCompanies)
@@ -1374,26 +2571,44 @@ def main():
         and the original dividend.
         There is no unique identificator that binds a reversal to a dividend, the
         assumption is that reversal amount, date and securityID match the reversed
-        dividend.
+        dividend. A reversal cancels the first remaining dividend that matches it either by
+        securityID or by symbol, so dividends are indexed under both keys in their original
+        order and cancelled entries are skipped when they reach the front of an index.
     """
-    for reversal in dividends.copy():
-        if reversal["amount"] < 0:
-            for dividend in dividends.copy():
-                if (
-                    dividend["dateTime"][0:8] == reversal["dateTime"][0:8]
-                    and float(dividend["amount"]) == -float(reversal["amount"])
-                    and (
-                        dividend["securityID"] == reversal["securityID"]
-                        or dividend["symbol"] == reversal["symbol"]
-                    )
-                ):
-                    print(
-                        "%s %s dividend of %s has been reversed, removing."
-                        % (dividend["symbol"], dividend["dateTime"], dividend["amount"])
-                    )
-                    dividends.remove(dividend)
-                    dividends.remove(reversal)
-                    break
+    dividendsBySecurityID = defaultdict(deque)
+    dividendsBySymbol = defaultdict(deque)
+    for i, dividend in enumerate(dividends):
+        if dividend.amount > 0:
+            date = dividend.dateTime[0:8]
+            dividendsBySecurityID[(date, dividend.amount, dividend.securityID)].append(i)
+            dividendsBySymbol[(date, dividend.amount, dividend.symbol)].append(i)
+
+    cancelled = [False] * len(dividends)
+    for r, reversal in enumerate(dividends):
+        if reversal.amount < 0:
+            date = reversal.dateTime[0:8]
+            first = None
+            for index in (
+                dividendsBySecurityID.get((date, -reversal.amount, reversal.securityID)),
+                dividendsBySymbol.get((date, -reversal.amount, reversal.symbol)),
+            ):
+                if index is None:
+                    continue
+                while index and cancelled[index[0]]:
+                    index.popleft()
+                if index and (first is None or index[0] < first):
+                    first = index[0]
+            if first is not None:
+                dividend = dividends[first]
+                print(
+                    "%s %s dividend of %s has been reversed, removing."
+                    % (dividend.symbol, dividend.dateTime, dividend.amount)
+                )
+                cancelled[first] = True
+                cancelled[r] = True
+    dividends = [
+        dividend for i, dividend in enumerate(dividends) if not cancelled[i]
+    ]
 
 
     """ Generate Doh-Div.xml """
@@ -1449,70 +2664,62 @@ def main():
         "isResident"
     ]
 
-    dividends = sorted(dividends, key=lambda k: k["dateTime"][0:8])
+    dividends = sorted(dividends, key=lambda k: k.dateTime[0:8])
     for dividend in dividends:
-        if round(dividend["amountEUR"], 2) <= 0:
+        if round(dividend.amountEUR, 2) <= 0:
             continue
-        Dividend = xml.etree.ElementTree.SubElement(body, "Dividend")
-        xml.etree.ElementTree.SubElement(Dividend, "Date").text = (
-            dYear + "-" + dividend["dateTime"][4:6] + "-" + dividend["dateTime"][6:8]
+        DividendElement = xml.etree.ElementTree.SubElement(body, "Dividend")
+        xml.etree.ElementTree.SubElement(DividendElement, "Date").text = (
+            dYear + "-" + dividend.dateTime[4:6] + "-" + dividend.dateTime[6:8]
         )
-        if "taxNumber" in dividend:
-            if dividend["taxNumber"] is not None and len(dividend["taxNumber"]) > 12:
-                dividend["taxNumber"] = re.sub(r'[^a-zA-Z0-9]+', "", dividend["taxNumber"])[0:12]
+        if dividend.taxNumber is not None:
+            if len(dividend.taxNumber) > 12:
+                dividend.taxNumber = re.sub(r'[^a-zA-Z0-9]+', "", dividend.taxNumber)[0:12]
 
             xml.etree.ElementTree.SubElement(
-                Dividend, "PayerIdentificationNumber"
-            ).text = dividend["taxNumber"]
-        if "name" in dividend:
-            xml.etree.ElementTree.SubElement(Dividend, "PayerName").text = dividend[
-                "name"
-            ]
+                DividendElement, "PayerIdentificationNumber"
+            ).text = dividend.taxNumber
+        if dividend.name is not None:
+            xml.etree.ElementTree.SubElement(DividendElement, "PayerName").text = dividend.name
         else:
-            xml.etree.ElementTree.SubElement(Dividend, "PayerName").text = dividend[
-                "symbol"
-            ]
-        if "address" in dividend:
-            xml.etree.ElementTree.SubElement(Dividend, "PayerAddress").text = dividend[
-                "address"
-            ]
-        if "country" in dividend:
-            xml.etree.ElementTree.SubElement(Dividend, "PayerCountry").text = dividend[
-                "country"
-            ]
-        xml.etree.ElementTree.SubElement(Dividend, "Type").text = "1"
-        xml.etree.ElementTree.SubElement(Dividend, "Value").text = "{0:.2f}".format(
-            dividend["amountEUR"]
+            xml.etree.ElementTree.SubElement(DividendElement, "PayerName").text = dividend.symbol
+        if dividend.address is not None:
+            xml.etree.ElementTree.SubElement(DividendElement, "PayerAddress").text = dividend.address
+        if dividend.country is not None:
+            xml.etree.ElementTree.SubElement(DividendElement, "PayerCountry").text = dividend.country
+        xml.etree.ElementTree.SubElement(DividendElement, "Type").text = "1"
+        xml.etree.ElementTree.SubElement(DividendElement, "Value").text = "{0:.2f}".format(
+            dividend.amountEUR
         )
         xml.etree.ElementTree.SubElement(
-            Dividend, "ForeignTax"
-        ).text = "{0:.2f}".format(dividend["taxEUR"])
-        if "country" in dividend:
-            xml.etree.ElementTree.SubElement(Dividend, "SourceCountry").text = dividend[
-                "country"
-            ]
-        if "reliefStatement" in dividend:
+            DividendElement, "ForeignTax"
+        ).text = "{0:.2f}".format(dividend.taxEUR)
+        if dividend.country is not None:
+            xml.etree.ElementTree.SubElement(DividendElement, "SourceCountry").text = dividend.country
+        if dividend.reliefStatement is not None:
             xml.etree.ElementTree.SubElement(
-                Dividend, "ReliefStatement"
-            ).text = dividend["reliefStatement"]
+                DividendElement, "ReliefStatement"
+            ).text = dividend.reliefStatement
         else:
-            xml.etree.ElementTree.SubElement(Dividend, "ReliefStatement").text = ""
+            xml.etree.ElementTree.SubElement(DividendElement, "ReliefStatement").text = ""
 
     xmlString = xml.etree.ElementTree.tostring(envelope)
     prettyXmlString = minidom.parseString(xmlString).toprettyxml(indent="\t")
-    with open("Doh-Div.xml", "w", encoding="utf-8") as f:
+    with open(getReportFilename("Doh-Div", reportYear, multipleYears), "w", encoding="utf-8") as f:
         f.write(prettyXmlString)
-        print("Doh-Div.xml created")
+        print(f.name + " created")
 
     """ Generate Doh-Obr.xml """
     doh_obr.generate(
         taxpayerConfig,
         ibEntities,
-        ibCashTransactionsList,
-        rates,
+        cashTransactions,
+        rateTable,
+        descriptionMatcher,
         reportYear,
         test,
         testYearDiff,
+        getReportFilename("Doh-Obr", reportYear, multipleYears),
     )
 
 
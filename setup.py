@@ -6,7 +6,7 @@ with open("README.md", "r", encoding="utf8") as fh:
 setup(
     name="ib_edavki",
     version="1.4.8",
-    py_modules=["ib_edavki", "generators.doh_obr"],
+    py_modules=["ib_edavki", "generators.doh_obr", "generators.records"],
     python_requires=">=3.9",
     install_requires=["requests", "certifi>=2024.8.30"],
     entry_points={